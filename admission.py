@@ -0,0 +1,167 @@
+import os, json, math, time, asyncio
+from collections import deque
+from metrics import Counter, register_collector
+from timing import span
+import db
+
+# "limit/queue/deadline": `limit` requests of a class run at once, up to `queue` more wait at most
+# `deadline` seconds for a slot, and anything past that gets a 503 straight away
+def _rule(env: str, default: str) -> tuple[int, int, float]:
+    limit, queue, deadline = os.environ.get(env, default).split("/")
+    return int(limit), int(queue), float(deadline)
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") == "1"
+# smoothed pool checkout wait above this shrinks the db-bound limits, below it they grow back
+ADMISSION_DB_WAIT_TARGET_MS = float(os.environ.get("ADMISSION_DB_WAIT_TARGET_MS", "50"))
+
+ADMISSION_REJECTED = Counter("admission_rejected_total", "Requests turned away with a 503 by admission control", ("class", "reason"))
+
+
+class Rejected(Exception):
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.retry_after = retry_after
+        self.reason = reason  # "queue_full" or "deadline"
+
+
+# FIFO slots for one class of request. with db_bound the limit follows the pool (AIMD):
+# checkouts waiting longer than the target cut it by a quarter, otherwise it creeps back up one at a time
+class AdmissionClass:
+    def __init__(self, name: str, limit: int, queue: int, deadline: float, db_bound: bool = False):
+        self.name = name
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.queue = queue
+        self.deadline = deadline
+        self.db_bound = db_bound
+        self.active = 0
+        self.service_time = 0.1  # smoothed seconds per admitted request, for Retry-After
+        self._waiters: deque[asyncio.Future] = deque()
+        self._last_adjust = time.monotonic()
+
+    def retry_after(self) -> float:
+        return self.service_time * (len(self._waiters) + 1) / max(self.limit, 1)
+
+    async def acquire(self):
+        if self.active < int(self.limit) and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue:
+            raise Rejected(self.retry_after(), "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            async with asyncio.timeout(self.deadline):
+                await waiter
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()  # handed a slot just as we gave up, pass it on
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            if isinstance(e, TimeoutError):
+                raise Rejected(self.retry_after(), "deadline") from None
+            raise
+
+    def release(self, elapsed: float):
+        self.service_time += 0.1 * (elapsed - self.service_time)
+        if self.db_bound:
+            self._adjust()
+        self._release_slot()
+
+    def _release_slot(self):
+        self.active -= 1
+        # the slot goes straight to the next waiter, so nobody can jump the queue
+        while self._waiters and self.active < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def _adjust(self):
+        now = time.monotonic()
+        if now - self._last_adjust < 0.5:
+            return
+        self._last_adjust = now
+        if db.checkout_wait.value * 1000 > ADMISSION_DB_WAIT_TARGET_MS:
+            self.limit = max(1.0, self.limit * 0.75)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1)
+
+    def stats(self) -> dict:
+        return {"limit": int(self.limit), "max_limit": self.max_limit, "active": self.active, "queued": len(self._waiters)}
+
+
+CLASSES = {
+    "auth": AdmissionClass("auth", *_rule("ADMISSION_AUTH", "4/16/3"), db_bound=True),
+    "db": AdmissionClass("db", *_rule("ADMISSION_DB", "16/64/2"), db_bound=True),
+    "llm": AdmissionClass("llm", *_rule("ADMISSION_LLM", "4/8/5")),
+    "spotify": AdmissionClass("spotify", *_rule("ADMISSION_SPOTIFY", "16/64/2")),
+}
+
+# first match wins; anything under /api that matches nothing counts as a db read
+ROUTE_CLASSES = [
+    ("/api/auth/signup", "auth"),
+    ("/api/auth/signin", "auth"),
+    ("/api/admin/songrecs", "llm"),
+    ("/api/spotify/", "spotify"),
+]
+# probes and metrics have to answer even (especially) when everything else is saturated
+UNLIMITED = ("/livez", "/readyz", "/api/admin/metrics")
+
+
+def classify(path: str) -> AdmissionClass | None:
+    if not path.startswith("/api/") or path.startswith(UNLIMITED):
+        return None
+    for prefix, name in ROUTE_CLASSES:
+        if path.startswith(prefix):
+            return CLASSES[name]
+    return CLASSES["db"]
+
+
+# pure ASGI, holds the slot until the response (streams included) is finished
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        admission = classify(scope["path"]) if scope["type"] == "http" and scope["method"] != "OPTIONS" else None
+        if admission is None or not ADMISSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            with span("admission-wait"):
+                await admission.acquire()
+        except Rejected as e:
+            ADMISSION_REJECTED.inc(admission.name, e.reason)
+            await self._reject(send, e.retry_after)
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            admission.release(time.perf_counter() - start)
+
+    async def _reject(self, send, retry_after: float):
+        body = json.dumps({"detail": "server busy, try again shortly"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+@register_collector
+def _admission_gauges():
+    samples = [("db_checkout_wait_seconds", {}, db.checkout_wait.value)]
+    for name, admission in CLASSES.items():
+        for key, value in admission.stats().items():
+            samples.append((f"admission_{key}", {"class": name}, value))
+    return samples
@@ -1,17 +1,32 @@
-import re, json, hashlib, hmac, jwt
-from fastapi import FastAPI, HTTPException, status, Depends
+import re, os, json, math, time, hashlib, hmac, uuid, asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, status, Depends, BackgroundTasks, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBearer
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from db import ping, pool
+from db import ping, pool, open_pool, close_pool, keepalive
+import repository
+from rate_limit import limiter, client_ip
+from maintenance import scheduler
+from membership import membership
 from psycopg.errors import UniqueViolation
-from crypto_utils import hash_password, verify_password 
+import crypto_utils
+from crypto_utils import hash_password, verify_password, needs_rehash, run_hash, HashingBusy
 from pydantic import BaseModel, Field, field_validator
-from jwt_utils import create_access_token, current_user, current_admin, current_owner, ACCESS_TOKEN_EXPIRE_MINUTES
-from open_ai_manager import chatManager
-from email_manager import EmailClient, issue_email_verification_link
+from jwt_utils import create_access_token, new_refresh_token, parse_refresh_token, current_user, current_admin, current_owner, invalidate_user, user_cache, ACCESS_TOKEN_EXPIRE_MINUTES
+import open_ai_manager
+from open_ai_manager import chatManager, JSONObjectStream
+from cache_utils import TTLCache
+from email_manager import new_verification_token, verification_email, outbox, base_url, EmailNotConfigured
 from datetime import datetime, timedelta, timezone
-from fastapi.responses import RedirectResponse
+from http_cache import cached_json
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse, JSONResponse
+import metrics
+import timing
+from admission import AdmissionMiddleware
+import spotify
+from resilience import UpstreamError, UpstreamUnavailable, breaker_states
+from shared_cache import cache as shared_cache
 from spotify import router as spotify_router
 
 ALLOWED_ORIGINS = [
@@ -25,8 +40,58 @@ PASSWORD_RE = re.compile(r"^[\x21-\x7E]+$") # Covers all ASCII but space
 
 security = HTTPBearer(auto_error=False)
 
-app = FastAPI()
+# readyz waits at most this long on the database so probes stay cheap
+READY_DB_TIMEOUT = float(os.environ.get("READY_DB_TIMEOUT", "2"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # nothing in here waits on the network or burns cpu, requests can be served straight away
+    calibration = asyncio.create_task(asyncio.to_thread(crypto_utils.calibrate))
+    await open_pool()
+    keepalive.start()
+    await spotify.open_client()
+    outbox.start()
+    scheduler.start()
+    membership.start()
+    yield
+    await membership.stop()
+    calibration.cancel()
+    await scheduler.stop()
+    await outbox.stop()
+    await open_ai_manager.close_client()
+    await spotify.close_client()
+    await keepalive.stop()
+    await close_pool()
+    crypto_utils.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+# upstream problems come out as 503 (we didn't try, with Retry-After) or 502 (we tried), never as their raw response
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable(request: Request, exc: UpstreamUnavailable):
+    return JSONResponse(
+        {"detail": f"{exc.upstream} is unavailable, try again shortly"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+@app.exception_handler(UpstreamError)
+async def upstream_error(request: Request, exc: UpstreamError):
+    return JSONResponse({"detail": f"{exc.upstream} request failed"}, status_code=status.HTTP_502_BAD_GATEWAY)
 app.include_router(spotify_router)
+# X-Profile: 1 from an admin answers with a cProfile of that request instead of its body
+async def profile_allowed(authorization: str | None) -> bool:
+    scheme, _, token = (authorization or "").partition(" ")
+    try:
+        user = await current_user(HTTPAuthorizationCredentials(scheme=scheme, credentials=token))
+    except Exception:  # bad token, or the db is down: just serve the request normally
+        return False
+    return user["role"] in ("admin", "owner")
+
+# innermost, so its queue wait shows up in Server-Timing and its 503s in the metrics
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(timing.TimingMiddleware, can_profile=profile_allowed)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS,
@@ -94,47 +159,117 @@ class SignInCreds(BaseModel):
         return password
     
 
+@app.get("/livez")
+async def livez():
+    return {"ok": True}
+
+async def _database_state() -> dict:
+    stats = pool.get_stats()
+    state = {"pool_size": stats.get("pool_size", 0), "available": stats.get("pool_available", 0)}
+    try:
+        await asyncio.wait_for(ping(), READY_DB_TIMEOUT)
+    except Exception as e:
+        return {"ok": False, "error": type(e).__name__, **state}
+    return {"ok": True, **state}
+
+# only the database decides readiness, the rest is reported so a bad deploy is easy to spot
+@app.get("/readyz")
+async def readyz():
+    database = await _database_state()
+    body = {
+        "ok": database["ok"],
+        "database": database,
+        "spotify": {"configured": spotify.is_configured(), "token_cached": spotify._cached_token() is not None},
+        "shared_cache": {"backend": shared_cache.name},
+        "openai": {"configured": open_ai_manager.is_configured(), "client_loaded": open_ai_manager._client is not None},
+        "email_outbox": {"running": outbox.running, "base_url_configured": bool(base_url())},
+        "maintenance": {"running": scheduler.running},
+        "hashing": {"scheme": crypto_utils.HASH_SCHEME, "calibrated": crypto_utils.calibrated},
+        "membership_index": {"loaded": membership.loaded_at is not None},
+        "upstreams": breaker_states(),
+    }
+    return JSONResponse(body, status_code=200 if database["ok"] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
 @app.get("/api/db/health", dependencies=[Depends(current_admin)])
-def db_health():
-    ok = False
+async def db_health():
+    start = time.perf_counter()
     try:
-        ok = ping()
+        ok = await ping()
     except Exception as e:
-        return {"ok": False, "error": str(e)}
-    return {"ok": ok}
+        return {"ok": False, "error": str(e), "pool": keepalive.stats(), "user_cache": user_cache.stats()}
+    ping_ms = round((time.perf_counter() - start) * 1000, 1)
+    return {"ok": ok, "ping_ms": ping_ms, "pool": keepalive.stats(), "user_cache": user_cache.stats()}
+
+# live form validation; both are optional but at least one is needed
+@app.get("/api/auth/availability")
+async def availability(request: Request, username: str | None = Query(None, max_length=32), email: str | None = Query(None, max_length=254)):
+    if not username and not email:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="username or email is required")
+    await limiter.check(("availability:ip", client_ip(request)))
+
+    username = username.strip().lower() if username else None
+    email = email.strip().lower() if email else None
+    username_taken, email_taken = await membership.taken(username, email)
+    result = {}
+    if username:
+        result["username"] = {"value": username, "available": not username_taken}
+    if email:
+        result["email"] = {"value": email, "available": not email_taken}
+    return result
 
 @app.post("/api/auth/signup", status_code=status.HTTP_201_CREATED)
-def sign_up(body: SignUpCreds):
+async def sign_up(body: SignUpCreds, request: Request):
+    # before any hashing or db work
+    await limiter.check(("signup:ip", client_ip(request)))
     try:
-        pwd_hash = hash_password(body.password)
-        with pool.connection() as conn, conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO users (username, email, email_verified, password_hash) VALUES (%s, %s, FALSE, %s) RETURNING id",
-                (body.username, body.email, pwd_hash),
-            )
-            user_id = cur.fetchone()[0]
-
-        verify_url = issue_email_verification_link(user_id)
-        EmailClient().send_verification(body.email, verify_url)
-        print(verify_url)
+        # a duplicate (or the frontend retrying) is turned away here instead of after a full hash
+        username_taken, email_taken = await membership.taken(body.username, body.email)
+        if username_taken:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="username already exists")
+        if email_taken:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="email already in use")
+
+        # first, so a missing BASE_URL fails the signup before any hashing
+        verification = new_verification_token()
+        pwd_hash = await run_hash(hash_password, body.password)
+        # user, tokens and queued email go in with one statement; the outbox dispatcher does the smtp part
+        refresh = new_refresh_token()
+        await repository.create_user(body.username, body.email, pwd_hash, verification, refresh, verification_email(verification.url))
+        membership.add(body.username, body.email)
+
+        outbox.notify()
+        print(verification.url)
                                         
         # role is user by default, so no need to check the db for role
-        token = create_access_token(username=body.username, role="user") 
-        expires_at = jwt.decode(token, options={"verify_signature": False})["exp"]
-        return {"ok": True, "message": "account created", "access_token": token, "token_type": "bearer", "expires_at": expires_at, "role": "user"}
+        token, expires_at = create_access_token(username=body.username, role="user") 
+        return {"ok": True, "message": "account created", **token_response(token, expires_at, "user", refresh)}
+
+    except HTTPException:
+        raise
 
-    except UniqueViolation:
+    # lost a race with another signup (or another worker's index hadn't seen it yet)
+    except UniqueViolation as e:
+        if "email" in (e.diag.constraint_name or ""):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="email already in use")
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="username already exists")
 
+    except HashingBusy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="too many requests, try again shortly", headers={"Retry-After": "1"})
+
+    # better no account than one whose verification link can't work
+    except EmailNotConfigured as e:
+        print(f"signup: {e}")
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="signup is unavailable right now")
+
     except Exception:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Sign Ups not working right now. Have to find a new API provider that won't block port 587...")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="signup failed")
     
 @app.post("/api/auth/signin", status_code=status.HTTP_200_OK)
-def sign_in(body: SignInCreds):
+async def sign_in(body: SignInCreds, request: Request, background_tasks: BackgroundTasks):
+    # before any hashing or db work
+    await limiter.check(("signin:ip", client_ip(request)), ("signin:user", body.username))
     try:
-        with pool.connection() as conn, conn.cursor() as cur:
-            cur.execute("SELECT password_hash, role, email_verified FROM users WHERE username = %s", (body.username,))
-            row = cur.fetchone()
+        row = await repository.get_user_credentials(body.username)
 
         if not row:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid credentials")
@@ -143,50 +278,133 @@ def sign_in(body: SignInCreds):
         role = row[1]
         email_verified = row[2]
 
-        if not verify_password(body.password, stored_hash):
+        if not await run_hash(verify_password, body.password, stored_hash):
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid credentials")
         if not email_verified:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="email not verified")
-        
-        token = create_access_token(username=body.username, role=role)
-        expires_at = jwt.decode(token, options={"verify_signature": False})["exp"]
-        return {"access_token": token, "token_type": "bearer", "expires_at": expires_at, "role": role}
+
+        # password checked out, so bring an old hash up to the current scheme/cost after responding
+        if needs_rehash(stored_hash):
+            background_tasks.add_task(rehash_password, body.username, body.password, stored_hash)
+
+        refresh = new_refresh_token()
+        await repository.insert_refresh_token(body.username, refresh)
+
+        token, expires_at = create_access_token(username=body.username, role=role)
+        return token_response(token, expires_at, role, refresh)
 
     except HTTPException:
         raise
+    except HashingBusy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="too many requests, try again shortly", headers={"Retry-After": "1"})
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="signin failed")
 
+def token_response(token: str, expires_at: int, role: str, refresh) -> dict:
+    return {
+        "access_token": token,
+        "token_type": "bearer",
+        "expires_at": expires_at,
+        "role": role,
+        "refresh_token": refresh.value,
+        "refresh_expires_at": int(refresh.expires_at.timestamp()),
+    }
+
+class RefreshBody(BaseModel):
+    refresh_token: str = Field(min_length=1, max_length=256)
+
+# trades a refresh token for a new access token + the next refresh token, no password hashing involved
+@app.post("/api/auth/refresh", status_code=status.HTTP_200_OK)
+async def refresh_access_token(body: RefreshBody):
+    parsed = parse_refresh_token(body.refresh_token)
+    if not parsed:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid refresh token")
+
+    refresh = new_refresh_token()
+    row = await repository.rotate_refresh_token(*parsed, refresh)
+    if not row:
+        await repository.revoke_reused_refresh_family(*parsed)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid refresh token")
+
+    username, role, email_verified = row
+    if not email_verified:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="email not verified")
+
+    token, expires_at = create_access_token(username=username, role=role)
+    return token_response(token, expires_at, role, refresh)
+
+@app.post("/api/auth/logout", status_code=status.HTTP_200_OK)
+async def logout(body: RefreshBody):
+    parsed = parse_refresh_token(body.refresh_token)
+    if parsed:
+        await repository.revoke_refresh_family(*parsed)
+    return {"ok": True}
+
+async def rehash_password(username: str, password: str, old_hash: str):
+    try:
+        new_hash = await run_hash(hash_password, password)
+    except HashingBusy:
+        return # busy, it'll get picked up on a later login
+    await repository.update_password_hash(username, new_hash, old_hash)
+
 @app.get("/api/auth/verify-email")
-def verify_email(token_id: str, token: str):
-    now = datetime.now(timezone.utc)
+async def verify_email(token_id: str, token: str):
+    try:
+        uuid.UUID(token_id)
+    except ValueError:
+        return RedirectResponse(url="https://rps9.net/verify/invalid.html", status_code=302)
 
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            "SELECT user_id, token_hash, expires_at, used_at FROM email_verifications WHERE id = %s",
-            (token_id,)
-        )
-        row = cur.fetchone()
+    presented = hashlib.sha256(token.encode()).hexdigest()
+    username = await repository.consume_verification(token_id, presented)
+    if username:
+        invalidate_user(username)
+        return RedirectResponse(url="https://rps9.net/verify/success.html", status_code=302)
 
-        if not row:
-            return RedirectResponse(url="https://rps9.net/verify/invalid.html", status_code=302)
+    # didn't go through, look the token up just to pick the right page
+    row = await repository.get_verification(token_id)
+    if not row:
+        return RedirectResponse(url="https://rps9.net/verify/invalid.html", status_code=302)
+
+    token_hash = row[0]
+    expires_at = row[1]
+    used_at = row[2]
+
+    if used_at is not None or datetime.now(timezone.utc) > expires_at:
+        return RedirectResponse(url="https://rps9.net/verify/expired.html", status_code=302)
 
-        user_id = row[0]
-        token_hash = row[1]
-        expires_at = row[2]
-        used_at = row[3]
+    if not hmac.compare_digest(token_hash, presented):
+        return RedirectResponse(url="https://rps9.net/verify/invalid.html", status_code=302)
 
-        if used_at is not None or now > expires_at:
-            return RedirectResponse(url="https://rps9.net/verify/expired.html", status_code=302)
+    # token looked fine but the update missed, e.g. it expired between the two queries
+    return RedirectResponse(url="https://rps9.net/verify/expired.html", status_code=302)
 
-        presented = hashlib.sha256(token.encode()).hexdigest()
-        if not hmac.compare_digest(token_hash, presented):
-            return RedirectResponse(url="https://rps9.net/verify/invalid.html", status_code=302)
 
-        cur.execute("UPDATE users SET email_verified = TRUE WHERE id = %s", (user_id,))
-        cur.execute("UPDATE email_verifications SET used_at = %s WHERE id = %s", (now, token_id,))
+@metrics.register_collector
+def _app_gauges():
+    samples = [(f"db_pool_{name}", {}, value) for name, value in pool.get_stats().items()]
+    for name, cache in (("user", user_cache), ("spotify_search", spotify.search_cache), ("songrecs", recs_cache)):
+        stats = cache.stats()
+        for key in ("size", "hits", "stale_hits", "misses"):
+            samples.append((f"cache_{key}", {"cache": name}, stats[key]))
+    samples.append(("email_outbox_sent", {}, outbox.sent))
+    samples.append(("email_outbox_failed", {}, outbox.failed))
+    samples.append(("membership_db_checks", {}, membership.db_checks))
+    samples.append(("membership_skipped_checks", {}, membership.skipped_checks))
+    return samples
 
-    return RedirectResponse(url="https://rps9.net/verify/success.html", status_code=302)
+@app.get("/api/admin/metrics", dependencies=[Depends(current_admin)], response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/admin/email/outbox", dependencies=[Depends(current_admin)])
+async def email_outbox_stats():
+    # counted on request rather than by the dispatcher, so an idle outbox never queries on its own
+    return {**outbox.stats(), "queue_depth": await repository.outbox_queue_depth()}
+
+@app.get("/api/admin/maintenance", dependencies=[Depends(current_admin)])
+async def maintenance_stats():
+    return scheduler.last_runs
 
 
 class SongInput(BaseModel):
@@ -201,39 +419,118 @@ class SongInput(BaseModel):
         return song_input
     
 
-@app.post("/api/admin/songrecs", dependencies=[Depends(current_admin)], status_code=status.HTTP_200_OK)
-def get_recs(body: SongInput):
+RECS_MODEL = "gpt-5-nano"
+recs_cache = TTLCache(
+    maxsize=int(os.environ.get("RECS_CACHE_SIZE", "256")),
+    ttl=float(os.environ.get("RECS_CACHE_TTL", "86400")),
+)
+# browser reuse for GET /api/admin/songrecs, same seeds -> same answer until the server cache drops it
+RECS_MAX_AGE = int(os.environ.get("RECS_MAX_AGE", "3600"))
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+# seed order and casing don't change the answer, so they don't change the key either
+def recs_cache_key(body: SongInput, model: str) -> tuple:
+    seeds = tuple(sorted({_normalize(s) for s in body.song_input}))
+    return (seeds, _normalize(body.additional_instructions), model)
+
+def build_recs_prompt(body: SongInput) -> str:
+    seeds = "\n".join(f"- {s}" for s in body.song_input)
+
+    prompt = (
+        "You are a helpful music recommendation assistant.\n"
+        "Task: Recommend 10 songs similar in vibe to the seed list.\n\n"
+        f"Seeds:\n{seeds}\n\n"
+        "Output format (strict JSON):\n"
+        '[{"title":"...", "artist":"...", "why":"one short sentence"}, {"title":"...", "artist":"...", "why":"..."}]\n'
+        "Rules: Do not include any of the seed songs in the output. Return exactly 10 items. No prose—JSON only."
+    )
+
+    if body.additional_instructions:
+        prompt += f"Additional instructions: {body.additional_instructions}"
+    return prompt
+
+async def stream_recs(body: SongInput, cache_key: tuple, enrich: bool = False):
+    recs = []
     try:
-        song_list = body.song_input
-        seeds = "\n".join(f"- {s}" for s in song_list)
+        gptAgent = chatManager(model=RECS_MODEL)
+        parser = JSONObjectStream()
+        async for text in gptAgent.stream_chat(prompt=build_recs_prompt(body)):
+            for rec in parser.feed(text):
+                recs.append(rec)
+                if enrich:
+                    # the model keeps writing the next one while this lookup runs
+                    rec = (await spotify.enrich_recs([rec]))[0]
+                yield json.dumps(rec) + "\n"
+    except Exception:
+        yield json.dumps({"error": "songrecs failed"}) + "\n"
+        return
+    if recs:
+        recs_cache.set(cache_key, recs)
 
-        prompt = (
-            "You are a helpful music recommendation assistant.\n"
-            "Task: Recommend 10 songs similar in vibe to the seed list.\n\n"
-            f"Seeds:\n{seeds}\n\n"
-            "Output format (strict JSON):\n"
-            '[{"title":"...", "artist":"...", "why":"one short sentence"}, {"title":"...", "artist":"...", "why":"..."}]\n'
-            "Rules: Do not include any of the seed songs in the output. Return exactly 10 items. No prose—JSON only."
-        )
+def ndjson_lines(items: list):
+    for item in items:
+        yield json.dumps(item) + "\n"
 
-        if body.additional_instructions:
-            prompt += f"Additional instructions: {body.additional_instructions}"
+async def recommend(body: SongInput, cache_key: tuple, cached, enrich: bool):
+    if cached is not None:
+        return cached
 
-        gptAgent = chatManager(model="gpt-5-nano")
-        raw_text_recommendations = gptAgent.chat(prompt=prompt)
+    try:
+        gptAgent = chatManager(model=RECS_MODEL)
+        raw_text_recommendations = await gptAgent.chat(prompt=build_recs_prompt(body))
 
         try:
             json_recommendations = json.loads(raw_text_recommendations)
+            recs_cache.set(cache_key, json_recommendations)
         except:
             json_recommendations = "it failed ]:" # has yet to fail but we'll see 
 
-        return {"recommendations": json_recommendations}
+        if enrich and isinstance(json_recommendations, list):
+            json_recommendations = await spotify.enrich_recs(json_recommendations)
+
+        return json_recommendations
         
-    except HTTPException:
+    except (HTTPException, UpstreamError, UpstreamUnavailable):
         raise
     except Exception:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="songrecs failed")
 
+# ?stream=true sends NDJSON, one recommendation per line as soon as the model finishes writing it
+# ?enrich=true adds the top spotify match (name, artists, image) to each one; the cache keeps them unenriched
+@app.post("/api/admin/songrecs", dependencies=[Depends(current_admin)], status_code=status.HTTP_200_OK)
+async def get_recs(body: SongInput, stream: bool = False, enrich: bool = False):
+    cache_key = recs_cache_key(body, RECS_MODEL)
+    cached = recs_cache.get(cache_key)
+    if enrich and isinstance(cached, list):
+        cached = await spotify.enrich_recs(cached)
+
+    if stream:
+        if cached is None:
+            open_ai_manager.breaker.raise_if_blocked()  # while it's down, say so with a 503 instead of a streamed error line
+        lines = ndjson_lines(cached) if cached is not None else stream_recs(body, cache_key, enrich)
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    return {"recommendations": await recommend(body, cache_key, cached, enrich)}
+
+# GET form of the non-streamed POST, so the browser can cache it:
+# /api/admin/songrecs?seed=Karma Police - Radiohead&seed=...&instructions=...&enrich=true
+@app.get("/api/admin/songrecs", dependencies=[Depends(current_admin)], status_code=status.HTTP_200_OK)
+async def get_recs_cacheable(
+    request: Request,
+    seed: list[str] = Query(..., min_length=1),
+    instructions: str = "",
+    enrich: bool = False,
+):
+    body = SongInput(song_input=seed, additional_instructions=instructions)
+    cache_key = recs_cache_key(body, RECS_MODEL)
+    cached = recs_cache.get(cache_key)
+    if enrich and isinstance(cached, list):
+        cached = await spotify.enrich_recs(cached)
+    recs = await recommend(body, cache_key, cached, enrich)
+    return cached_json(request, {"recommendations": recs}, RECS_MAX_AGE if isinstance(recs, list) else 0)
+
 class BestowRoleBody(BaseModel):
     username: str
     role: str
@@ -244,17 +541,54 @@ class BestowRoleBody(BaseModel):
         return str(username).strip().lower()
 
 @app.post("/api/owner/bestow-role", dependencies=[Depends(current_owner)], status_code=status.HTTP_200_OK)
-def bestow_admin(body: BestowRoleBody):
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            "UPDATE users SET role = %s WHERE username = %s AND role <> %s",
-            (body.role, body.username, body.role),
-        )
-        if cur.rowcount == 0:
-            cur.execute("SELECT role FROM users WHERE username = %s", (body.username,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
-            if row[0] == body.role:
-                return {"ok": True, "message": f"user is already role: {body.role}"}
-        return {"ok": True, "message": f"{body.username} is now role: {body.role}"}
+async def bestow_admin(body: BestowRoleBody):
+    row = await repository.set_role(body.username, body.role)
+    if not row:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="user not found")
+
+    previous_role, changed = row
+    if not changed:
+        return {"ok": True, "message": f"user is already role: {body.role}"}
+
+    invalidate_user(body.username)
+    return {"ok": True, "message": f"{body.username} is now role: {body.role}"}
+
+class BestowRolesBody(BaseModel):
+    changes: list[BestowRoleBody] = Field(min_length=1, max_length=1000)
+
+@app.post("/api/owner/bestow-roles", dependencies=[Depends(current_owner)], status_code=status.HTTP_200_OK)
+async def bestow_roles(body: BestowRolesBody):
+    rows = await repository.set_roles([c.username for c in body.changes], [c.role for c in body.changes])
+
+    results = []
+    for username, role, previous_role, changed in rows:
+        if previous_role is None:
+            outcome = "not_found"
+        elif changed:
+            outcome = "updated"
+            invalidate_user(username)
+        else:
+            outcome = "unchanged"
+        results.append({"username": username, "role": role, "previous_role": previous_role, "outcome": outcome})
+    return {"ok": True, "results": results}
+
+async def user_lines(after_id: int, limit: int | None, role: str | None, verified: bool | None):
+    async for user_id, username, email, user_role, email_verified, created_at in repository.iter_users(after_id, limit, role, verified):
+        yield json.dumps({
+            "id": user_id,
+            "username": username,
+            "email": email,
+            "role": user_role,
+            "email_verified": email_verified,
+            "created_at": created_at.isoformat() if created_at else None,
+        }) + "\n"
+
+# NDJSON, one user per line ordered by id; pass the last id back as after_id for the next page
+@app.get("/api/admin/users", dependencies=[Depends(current_admin)])
+async def list_users(
+    after_id: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1),
+    role: str | None = None,
+    verified: bool | None = None,
+):
+    return StreamingResponse(user_lines(after_id, limit, role, verified), media_type="application/x-ndjson")
\ No newline at end of file
@@ -0,0 +1,69 @@
+import os, sys, json, math, time, platform, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def git_commit() -> tuple[str, bool]:
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip())
+        return sha or "unknown", dirty
+    except OSError:
+        return "unknown", False
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest-rank
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+# latencies in seconds -> the numbers that get compared across commits
+def summarize(latencies: list, elapsed: float, errors: int = 0, status_codes: dict | None = None) -> dict:
+    ordered = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3)
+    summary = {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": round(len(ordered) / elapsed, 2) if elapsed > 0 else 0.0,
+        "mean_ms": ms(sum(ordered) / len(ordered)) if ordered else 0.0,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1]) if ordered else 0.0,
+    }
+    if status_codes is not None:
+        summary["status_codes"] = status_codes
+    return summary
+
+
+def write_results(kind: str, scenarios: dict, extra: dict | None = None, out: str | None = None) -> str:
+    sha, dirty = git_commit()
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{sha}{'-dirty' if dirty else ''}-{kind}.json")
+    payload = {
+        "kind": kind,
+        "commit": sha,
+        "dirty": dirty,
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        **(extra or {}),
+        "scenarios": scenarios,
+    }
+    with open(out, "w") as f:
+        json.dump(payload, f, indent=2)
+    return out
+
+
+def print_table(scenarios: dict):
+    print(f"{'scenario':<28}{'reqs':>7}{'err':>5}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, s in scenarios.items():
+        print(f"{name:<28}{s['requests']:>7}{s['errors']:>5}{s['throughput_rps']:>10}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}")
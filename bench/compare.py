@@ -0,0 +1,36 @@
+# Compares two results files from bench/endpoints.py or bench/micro.py.
+#
+#   python bench/compare.py bench/results/abc1234-endpoints.json bench/results/def5678-endpoints.json
+import sys, json
+
+METRICS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(before: float, after: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    if len(sys.argv) != 3:
+        raise SystemExit("usage: compare.py BEFORE.json AFTER.json")
+    before, after = load(sys.argv[1]), load(sys.argv[2])
+    print(f"{before['commit']} -> {after['commit']}")
+    print(f"{'scenario':<28}" + "".join(f"{m:>26}" for m in METRICS))
+    for name in sorted(set(before["scenarios"]) | set(after["scenarios"])):
+        a, b = before["scenarios"].get(name), after["scenarios"].get(name)
+        if a is None or b is None:
+            print(f"{name:<28}  only in {'after' if a is None else 'before'}")
+            continue
+        cells = "".join(f"{f'{a[m]} -> {b[m]} ({change(a[m], b[m])})':>26}" for m in METRICS)
+        print(f"{name:<28}{cells}")
+
+
+if __name__ == "__main__":
+    main()
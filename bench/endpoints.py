@@ -0,0 +1,231 @@
+# Drives every route of app:app in-process under controlled concurrency.
+#
+#   DATABASE_URL=postgresql://localhost/bench python bench/endpoints.py -c 20 -n 200
+#
+# Postgres is real (use a throwaway database loaded with bench/schema.sql and sql/*.sql).
+# Spotify and OpenAI go through httpx.MockTransport and email goes to a local SMTP sink,
+# see bench/fakes.py. Results land in bench/results/<commit>-endpoints.json.
+import os, time, uuid, asyncio, argparse
+from collections import Counter
+from urllib.parse import urlsplit
+
+from common import summarize, write_results, print_table
+import fakes
+
+import httpx
+
+PASSWORD = "bench-password-1"
+
+
+def configure_env(smtp_port: int):
+    if not os.environ.get("DATABASE_URL"):
+        raise SystemExit("set DATABASE_URL to a throwaway database")
+    os.environ.setdefault("SECRET_KEY", "bench-secret")
+    os.environ.setdefault("BASE_URL", "http://bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["EMAIL_PASSWORD"] = ""
+    os.environ["SMTP_HOST"] = "127.0.0.1"
+    os.environ["SMTP_PORT"] = str(smtp_port)
+    os.environ["SMTP_STARTTLS"] = "0"
+    # measure the endpoints, not the abuse protection in front of them
+    for name in ("RATE_LIMIT_SIGNIN_IP", "RATE_LIMIT_SIGNIN_USER", "RATE_LIMIT_SIGNUP_IP"):
+        os.environ.setdefault(name, "1000000/1")
+    os.environ.setdefault("HASH_QUEUE_DEPTH", "100000")
+    # or the 503s from admission control at -c 20 get timed as if they were the endpoint
+    os.environ.setdefault("ADMISSION_ENABLED", "0")
+
+
+async def setup_fixtures(run: str, verify_count: int) -> dict:
+    from db import pool
+    from crypto_utils import hash_password
+    from email_manager import new_verification_token
+    from jwt_utils import create_access_token
+    import repository
+
+    pwd_hash = hash_password(PASSWORD)
+    users = {
+        "admin": ("admin", True),
+        "owner": ("owner", True),
+        "target": ("user", True),
+        "signin": ("user", True),
+    }
+    users.update({f"verify{i}": ("user", False) for i in range(verify_count)})
+
+    ids = {}
+    async with pool.connection() as conn, conn.cursor() as cur:
+        for key, (role, verified) in users.items():
+            await cur.execute(
+                "INSERT INTO users (username, email, email_verified, password_hash, role) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+                (f"bench_{run}_{key}", f"bench_{run}_{key}@bench.local", verified, pwd_hash, role),
+            )
+            ids[key] = (await cur.fetchone())[0]
+
+    verify_links = []
+    for i in range(verify_count):
+        token = new_verification_token()
+        await repository.replace_verification(ids[f"verify{i}"], token)
+        parts = urlsplit(token.url)
+        verify_links.append(f"{parts.path}?{parts.query}")
+
+    return {
+        "admin_token": create_access_token(username=f"bench_{run}_admin", role="admin")[0],
+        "owner_token": create_access_token(username=f"bench_{run}_owner", role="owner")[0],
+        "signin_username": f"bench_{run}_signin",
+        "target_username": f"bench_{run}_target",
+        "verify_links": verify_links,
+    }
+
+
+async def cleanup(run: str):
+    from db import pool
+    async with pool.connection() as conn, conn.cursor() as cur:
+        pattern = f"bench_{run}_%"
+        await cur.execute("DELETE FROM email_outbox WHERE recipient LIKE %s", (pattern,))
+        await cur.execute("DELETE FROM email_verifications WHERE user_id IN (SELECT id FROM users WHERE username LIKE %s)", (pattern,))
+        await cur.execute("DELETE FROM refresh_tokens WHERE user_id IN (SELECT id FROM users WHERE username LIKE %s)", (pattern,))
+        await cur.execute("DELETE FROM users WHERE username LIKE %s", (pattern,))
+
+
+def scenarios(run: str, f: dict) -> dict:
+    admin = {"Authorization": f"Bearer {f['admin_token']}"}
+    owner = {"Authorization": f"Bearer {f['owner_token']}"}
+    warm_queries = ["taylor", "taylor s", "taylor swift", "radiohead", "daft punk"]
+
+    def signup(i):
+        body = {"username": f"bench_{run}_new{i}", "password": PASSWORD, "email": f"bench_{run}_new{i}@bench.local"}
+        return "POST", "/api/auth/signup", {"json": body}
+
+    def signin(i):
+        return "POST", "/api/auth/signin", {"json": {"username": f["signin_username"], "password": PASSWORD}}
+
+    def verify_email(i):
+        return "GET", f["verify_links"][i % len(f["verify_links"])], {}
+
+    def search_cold(i):
+        return "GET", "/api/spotify/search", {"params": {"q": f"{run} cold {i}"}, "headers": admin}
+
+    def search_warm(i):
+        return "GET", "/api/spotify/search", {"params": {"q": warm_queries[i % len(warm_queries)]}, "headers": admin}
+
+    def songrecs_cold(i):
+        body = {"song_input": [f"{run} seed {i}"], "additional_instructions": ""}
+        return "POST", "/api/admin/songrecs", {"json": body, "headers": admin}
+
+    def songrecs_cached(i):
+        body = {"song_input": ["Karma Police - Radiohead"], "additional_instructions": ""}
+        return "POST", "/api/admin/songrecs", {"json": body, "headers": admin}
+
+    def search_batch(i):
+        body = {"queries": [f"{run} batch {i} {n}" for n in range(10)] + warm_queries[:1]}
+        return "POST", "/api/spotify/search/batch", {"json": body, "headers": admin}
+
+    def songrecs_enriched(i):
+        body = {"song_input": ["Karma Police - Radiohead"], "additional_instructions": ""}
+        return "POST", "/api/admin/songrecs", {"json": body, "headers": admin, "params": {"enrich": "true"}}
+
+    def songrecs_stream(i):
+        body = {"song_input": [f"{run} stream seed {i}"], "additional_instructions": ""}
+        return "POST", "/api/admin/songrecs", {"json": body, "headers": admin, "params": {"stream": "true"}}
+
+    def bestow_role(i):
+        body = {"username": f["target_username"], "role": "admin" if i % 2 else "user"}
+        return "POST", "/api/owner/bestow-role", {"json": body, "headers": owner}
+
+    return {
+        "signup": signup,
+        "signin": signin,
+        "verify-email": verify_email,
+        "spotify-search-cold": search_cold,
+        "spotify-search-warm": search_warm,
+        "songrecs-cold": songrecs_cold,
+        "songrecs-cached": songrecs_cached,
+        "spotify-search-batch": search_batch,
+        "songrecs-enriched": songrecs_enriched,
+        "songrecs-stream": songrecs_stream,
+        "bestow-role": bestow_role,
+    }
+
+
+async def drive(client: httpx.AsyncClient, make_request, total: int, concurrency: int) -> dict:
+    latencies, codes = [], Counter()
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal errors, next_index
+        while next_index < total:
+            i = next_index
+            next_index += 1
+            method, url, kwargs = make_request(i)
+            start = time.perf_counter()
+            try:
+                res = await client.request(method, url, **kwargs)
+                await res.aread()
+                codes[res.status_code] += 1
+                if res.status_code >= 400:
+                    errors += 1
+            except Exception:
+                codes["exception"] += 1
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start, errors, {str(k): v for k, v in codes.items()})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="endpoint benchmarks against app:app")
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument("-n", "--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--hash-requests", type=int, default=50, help="requests for signup/signin, which hash passwords")
+    parser.add_argument("-s", "--scenario", action="append", help="only run these (repeatable)")
+    parser.add_argument("-o", "--out", help="results file (default bench/results/<commit>-endpoints.json)")
+    parser.add_argument("--keep", action="store_true", help="leave the bench users in the database")
+    args = parser.parse_args()
+
+    sink = fakes.SMTPSink()
+    await sink.start()
+    configure_env(sink.port)
+
+    import app as app_module
+    import spotify, open_ai_manager
+    from openai import AsyncOpenAI
+
+    app = app_module.app
+    run = uuid.uuid4().hex[:8]
+    results = {}
+
+    async with app.router.lifespan_context(app):
+        await spotify.close_client()
+        await spotify.open_client(transport=httpx.MockTransport(fakes.spotify_handler))
+        await open_ai_manager.close_client()
+        open_ai_manager._client = AsyncOpenAI(
+            api_key="bench",
+            base_url="http://openai.bench/v1",
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(fakes.openai_handler)),
+        )
+
+        fixtures = await setup_fixtures(run, args.requests)
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                for name, make_request in scenarios(run, fixtures).items():
+                    if args.scenario and name not in args.scenario:
+                        continue
+                    total = args.hash_requests if name in ("signup", "signin") else args.requests
+                    results[name] = await drive(client, make_request, total, args.concurrency)
+                    print(f"{name}: done")
+        finally:
+            if not args.keep:
+                await cleanup(run)
+
+    await sink.stop()
+    out = write_results("endpoints", results, {"concurrency": args.concurrency, "upstream_calls": dict(fakes.calls)}, args.out)
+    print_table(results)
+    print(f"upstream calls: {fakes.calls}")
+    print(f"wrote {out}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
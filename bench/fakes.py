@@ -0,0 +1,106 @@
+import os, json, asyncio
+import httpx
+
+# local stand-ins for everything the api talks to besides postgres.
+# BENCH_UPSTREAM_LATENCY_MS adds a fixed delay to every fake upstream response.
+
+UPSTREAM_LATENCY = float(os.environ.get("BENCH_UPSTREAM_LATENCY_MS", "0")) / 1000
+
+calls = {"spotify_token": 0, "spotify_search": 0, "openai": 0, "smtp_messages": 0}
+
+
+def _track(i: int, q: str) -> dict:
+    return {
+        "name": f"{q} song {i}",
+        "artists": [{"name": f"artist {i}"}],
+        "album": {"images": [{"url": f"https://img.example/{i}/640"}, {"url": f"https://img.example/{i}/64"}]},
+    }
+
+
+async def spotify_handler(request: httpx.Request) -> httpx.Response:
+    if UPSTREAM_LATENCY:
+        await asyncio.sleep(UPSTREAM_LATENCY)
+    if request.url.host == "accounts.spotify.com":
+        calls["spotify_token"] += 1
+        return httpx.Response(200, json={"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600})
+    calls["spotify_search"] += 1
+    q = request.url.params.get("q", "")
+    return httpx.Response(200, json={"tracks": {"items": [_track(i, q) for i in range(8)]}})
+
+
+RECS = [{"title": f"song {i}", "artist": f"artist {i}", "why": "same vibe"} for i in range(10)]
+
+def _completion(content: str) -> dict:
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-5-nano",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+def _chunk(content: str | None, finish: str | None = None) -> bytes:
+    delta = {"content": content} if content is not None else {}
+    body = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "gpt-5-nano",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+    }
+    return f"data: {json.dumps(body)}\n\n".encode()
+
+async def openai_handler(request: httpx.Request) -> httpx.Response:
+    calls["openai"] += 1
+    if UPSTREAM_LATENCY:
+        await asyncio.sleep(UPSTREAM_LATENCY)
+    payload = json.loads(request.content)
+    content = json.dumps(RECS)
+    if not payload.get("stream"):
+        return httpx.Response(200, json=_completion(content))
+
+    # ~20 chars per chunk, like a real token stream
+    parts = [content[i:i + 20] for i in range(0, len(content), 20)]
+    body = b"".join(_chunk(p) for p in parts) + _chunk(None, "stop") + b"data: [DONE]\n\n"
+    return httpx.Response(200, content=body, headers={"content-type": "text/event-stream"})
+
+
+# bare minimum SMTP server: accepts everything and throws it away
+class SMTPSink:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host, self.port = host, port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(b"220 bench-sink ESMTP\r\n")
+        try:
+            while line := await reader.readline():
+                command = line.decode(errors="replace").strip().upper()
+                if command.startswith(("EHLO", "HELO")):
+                    writer.write(b"250-bench-sink\r\n250 8BITMIME\r\n")
+                elif command.startswith("DATA"):
+                    writer.write(b"354 go ahead\r\n")
+                    await writer.drain()
+                    while (await reader.readline()) not in (b".\r\n", b""):
+                        pass
+                    calls["smtp_messages"] += 1
+                    writer.write(b"250 queued\r\n")
+                elif command.startswith("QUIT"):
+                    writer.write(b"221 bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b"250 ok\r\n")
+                await writer.drain()
+        finally:
+            writer.close()
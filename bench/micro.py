@@ -0,0 +1,62 @@
+# Microbenchmarks for password hashing and JWT encode/decode.
+#
+#   python bench/micro.py
+#
+# Results land in bench/results/<commit>-micro.json, same shape as the endpoint results.
+import os, time, argparse
+
+from common import summarize, write_results, print_table
+
+# jwt_utils pulls in db, which wants a url even though nothing connects here
+os.environ.setdefault("DATABASE_URL", "postgresql://bench@localhost/bench")
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+
+import jwt
+import crypto_utils
+import jwt_utils
+
+
+def measure(fn, iterations: int) -> dict:
+    fn()  # warm up
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hashing and jwt microbenchmarks")
+    parser.add_argument("--hash-iterations", type=int, default=20)
+    parser.add_argument("--jwt-iterations", type=int, default=20000)
+    parser.add_argument("-o", "--out", help="results file (default bench/results/<commit>-micro.json)")
+    args = parser.parse_args()
+
+    results = {}
+    for scheme, hasher in crypto_utils.HASHERS.items():
+        stored = hasher.hash("bench-password-1")
+        results[f"{scheme}-hash"] = measure(lambda: hasher.hash("bench-password-1"), args.hash_iterations)
+        results[f"{scheme}-verify"] = measure(lambda: crypto_utils.verify_password("bench-password-1", stored), args.hash_iterations)
+
+    token = jwt_utils.create_access_token(username="bench", role="admin")
+    if isinstance(token, tuple):
+        token = token[0]
+    results["jwt-encode"] = measure(lambda: jwt_utils.create_access_token(username="bench", role="admin"), args.jwt_iterations)
+    results["jwt-decode"] = measure(
+        lambda: jwt.decode(token, jwt_utils.SECRET_KEY, algorithms=[jwt_utils.ALGORITHM]),
+        args.jwt_iterations,
+    )
+
+    params = {
+        "pbkdf2_iterations": crypto_utils.HASHERS["pbkdf2"].iterations,
+        "scrypt_n": crypto_utils.HASHERS["scrypt"].n,
+    }
+    out = write_results("micro", results, params, args.out)
+    print_table(results)
+    print(f"wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
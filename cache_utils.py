@@ -0,0 +1,80 @@
+import time, threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+# small LRU + TTL cache, safe to share between the threadpool workers
+# stale_ttl keeps entries around past their ttl so callers can serve them while refreshing
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, stale_ttl: float = 0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()  # key -> (fresh_until, stale_until, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        found = self.lookup(key, allow_stale=False)
+        return default if found is None else found[0]
+
+    # returns (value, is_fresh) or None
+    def lookup(self, key, allow_stale: bool = True):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[1] <= now:
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            fresh = entry[0] > now
+            if not fresh and not allow_stale:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+            return entry[2], fresh
+
+    def set(self, key, value, ttl: float | None = None):
+        fresh_until = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (fresh_until, fresh_until + self.stale_ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    # drops every entry whose key matches, e.g. all tokens for one username
+    def delete_where(self, predicate) -> int:
+        with self._lock:
+            doomed = [k for k in self._data if predicate(k)]
+            for k in doomed:
+                del self._data[k]
+        return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
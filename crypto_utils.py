@@ -1,6 +1,27 @@
-import os, base64, hashlib, hmac
+import os, base64, hashlib, hmac, time, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from metrics import HASH_SECONDS
+from timing import span
 
+# hashlib releases the GIL for pbkdf2 and scrypt so threads are enough here
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", "2"))
+HASH_QUEUE_DEPTH = int(os.environ.get("HASH_QUEUE_DEPTH", "8"))
+HASH_SCHEME = os.environ.get("HASH_SCHEME", "pbkdf2")  # pbkdf2 or scrypt
+HASH_TARGET_MS = float(os.environ.get("HASH_TARGET_MS", "0"))  # 0 = skip benchmarking, use the floors below
+
+# floors, calibration only ever goes up from these
 ITERATIONS = 150_000
+# calibrated iteration counts come in steps of this, so benchmark noise between restarts (or workers)
+# doesn't change the target each time; is_current also lets hashes within REHASH_TOLERANCE of it stand
+ITERATION_STEP = 50_000
+REHASH_TOLERANCE = 0.1
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+MAX_SCRYPT_N = 2 ** 17
+
+class HashingBusy(Exception):
+    pass
 
 def _b64(b: bytes) -> str:
     return base64.b64encode(b).decode("utf-8")
@@ -8,13 +29,23 @@ def _b64(b: bytes) -> str:
 def _db64(s: str) -> bytes:
     return base64.b64decode(s.encode("utf-8"))
 
-def hash_password(password: str) -> str:
-    salt = os.urandom(16)
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, ITERATIONS, dklen=32)
-    return f"pbkdf2$sha256${ITERATIONS}${_b64(salt)}${_b64(dk)}"
+def _scrypt(password: bytes, salt: bytes, n: int, r: int, p: int, dklen: int = 32) -> bytes:
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, dklen=dklen, maxmem=256 * n * r * p + 1024 * 1024)
 
-def verify_password(password: str, stored: str) -> bool:
-    try:
+
+# each scheme knows how to hash with the current params, verify its own format and say if a stored hash is outdated
+class PBKDF2Hasher:
+    scheme = "pbkdf2"
+
+    def __init__(self, iterations: int = ITERATIONS):
+        self.iterations = iterations
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, self.iterations, dklen=32)
+        return f"pbkdf2$sha256${self.iterations}${_b64(salt)}${_b64(dk)}"
+
+    def verify(self, password: str, stored: str) -> bool:
         scheme, algo, iters, salt_b64, hash_b64 = stored.split("$")
         if scheme != "pbkdf2" or algo != "sha256":
             return False
@@ -23,5 +54,111 @@ def verify_password(password: str, stored: str) -> bool:
         expected = _db64(hash_b64)
         dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations, dklen=len(expected))
         return hmac.compare_digest(dk, expected)
+
+    def is_current(self, stored: str) -> bool:
+        parts = stored.split("$")
+        return parts[0] == "pbkdf2" and int(parts[2]) >= self.iterations * (1 - REHASH_TOLERANCE)
+
+    def calibrate(self, target_ms: float):
+        sample = 20_000
+        start = time.perf_counter()
+        hashlib.pbkdf2_hmac("sha256", b"calibration", b"0" * 16, sample, dklen=32)
+        per_iter_ms = (time.perf_counter() - start) * 1000 / sample
+        self.iterations = max(ITERATIONS, round(target_ms / per_iter_ms / ITERATION_STEP) * ITERATION_STEP)
+
+
+class ScryptHasher:
+    scheme = "scrypt"
+
+    def __init__(self, n: int = SCRYPT_N, r: int = SCRYPT_R, p: int = SCRYPT_P):
+        self.n, self.r, self.p = n, r, p
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        dk = _scrypt(password.encode(), salt, self.n, self.r, self.p)
+        return f"scrypt${self.n}${self.r}${self.p}${_b64(salt)}${_b64(dk)}"
+
+    def verify(self, password: str, stored: str) -> bool:
+        scheme, n, r, p, salt_b64, hash_b64 = stored.split("$")
+        if scheme != "scrypt":
+            return False
+        expected = _db64(hash_b64)
+        dk = _scrypt(password.encode(), _db64(salt_b64), int(n), int(r), int(p), dklen=len(expected))
+        return hmac.compare_digest(dk, expected)
+
+    def is_current(self, stored: str) -> bool:
+        parts = stored.split("$")
+        return parts[0] == "scrypt" and int(parts[1]) >= self.n and int(parts[2]) == self.r and int(parts[3]) == self.p
+
+    def calibrate(self, target_ms: float):
+        n = SCRYPT_N
+        while n < MAX_SCRYPT_N:
+            start = time.perf_counter()
+            _scrypt(b"calibration", b"0" * 16, n, self.r, self.p)
+            if (time.perf_counter() - start) * 1000 >= target_ms:
+                break
+            n *= 2
+        self.n = n
+
+
+HASHERS = {
+    "pbkdf2": PBKDF2Hasher(),
+    "scrypt": ScryptHasher(),
+}
+
+def current_hasher():
+    return HASHERS[HASH_SCHEME]
+
+calibrated = HASH_TARGET_MS <= 0
+
+# benchmarks the current scheme; until it finishes new hashes just use the floors
+def calibrate():
+    global calibrated
+    if HASH_TARGET_MS > 0:
+        current_hasher().calibrate(HASH_TARGET_MS)
+    calibrated = True
+
+def hash_password(password: str) -> str:
+    return current_hasher().hash(password)
+
+def verify_password(password: str, stored: str) -> bool:
+    try:
+        hasher = HASHERS.get(stored.split("$", 1)[0])
+        if hasher is None:
+            return False
+        return hasher.verify(password, stored)
     except Exception:
         return False
+
+def needs_rehash(stored: str) -> bool:
+    try:
+        return not current_hasher().is_current(stored)
+    except Exception:
+        return True
+
+
+# bounded executor: HASH_WORKERS running + HASH_QUEUE_DEPTH waiting, anything past that is rejected right away
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+_hash_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_DEPTH)
+
+def _timed(fn, *args):
+    with HASH_SECONDS.time(fn.__name__):
+        return fn(*args)
+
+def submit_hash(fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = hash_executor.submit(_timed, fn, *args)
+    except Exception:
+        _hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hash_slots.release())
+    return future
+
+async def run_hash(fn, *args):
+    with span("hash"):
+        return await asyncio.wrap_future(submit_hash(fn, *args))
+
+def shutdown():
+    hash_executor.shutdown(wait=False, cancel_futures=True)
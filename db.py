@@ -1,15 +1,180 @@
-import os
-from psycopg_pool import ConnectionPool
-from contextlib import contextmanager
-from psycopg.errors import OperationalError, InterfaceError
+import os, time, random, asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from timing import span
 
-DATABASE_URL = os.environ["DATABASE_URL"]
+# read here but only used when the pool opens, so importing the app never needs the database
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
 
-pool = ConnectionPool(conninfo=DATABASE_URL, min_size=1, max_size=5, timeout=10, check=ConnectionPool.check_connection)
+# min_size connections are kept open (and, with keepalive on, checked) so a signin doesn't pay for a reconnect
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "600"))
+# checkouts that time out while the pool is reconnecting (neon waking up) are retried this many times with
+# jittered backoff; all the attempts together still give up after DB_POOL_TIMEOUT
+DB_CHECKOUT_RETRIES = int(os.environ.get("DB_CHECKOUT_RETRIES", "2"))
+DB_RETRY_BASE = float(os.environ.get("DB_RETRY_BASE", "0.25"))
+# neon suspends compute after ~5 idle minutes; pinging more often than that keeps it awake. 0 turns it off
+DB_KEEPALIVE_INTERVAL = float(os.environ.get("DB_KEEPALIVE_INTERVAL", "0"))
+# UTC hours to keep it awake in, e.g. "14-23,0-4"; empty means all day
+DB_KEEPALIVE_HOURS = os.environ.get("DB_KEEPALIVE_HOURS", "")
 
-def ping() -> bool:
-    with pool.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1;")
-            cur.fetchone()
-            return True
\ No newline at end of file
+# opened in the app lifespan, nothing connects at import
+pool = AsyncConnectionPool(
+    conninfo=DATABASE_URL,
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    max_idle=DB_POOL_MAX_IDLE,
+    check=AsyncConnectionPool.check_connection,
+    open=False,
+)
+
+# wait=False: connections are made in the background, so a sleeping database doesn't hold up startup
+async def open_pool():
+    await pool.open(wait=False)
+
+async def close_pool():
+    await pool.close()
+
+
+# smoothed time spent waiting on pool checkouts, admission control shrinks its db limits when it climbs
+class CheckoutWait:
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.value = 0.0
+
+    def observe(self, seconds: float):
+        self.value += self.alpha * (seconds - self.value)
+
+checkout_wait = CheckoutWait()
+
+
+def _connection_errors() -> int:
+    return pool.get_stats().get("connections_errors", 0)
+
+# getconn() never raises connect errors, the pool keeps trying in the background and the checkout just
+# times out. a retry only helps if that's what happened: no connections at all, or failed connects since
+def _reconnecting(errors_before: int) -> bool:
+    return pool.get_stats().get("pool_size", 0) == 0 or _connection_errors() > errors_before
+
+
+# pool.connection() with retries on the checkout only; once a query has run it's never retried here
+@asynccontextmanager
+async def connection():
+    start = time.perf_counter()
+    deadline = start + DB_POOL_TIMEOUT
+    errors = _connection_errors()
+    with span("db-checkout"):
+        attempt = 0
+        while True:
+            left = deadline - time.perf_counter()
+            # each attempt gets its share of what's left, so retries never stretch past DB_POOL_TIMEOUT
+            timeout = left / (DB_CHECKOUT_RETRIES + 1 - attempt)
+            try:
+                conn = await pool.getconn(timeout=max(timeout, 0.001))
+                break
+            except PoolTimeout:
+                if attempt == DB_CHECKOUT_RETRIES or time.perf_counter() >= deadline:
+                    raise
+                if not _reconnecting(errors):
+                    # the pool is healthy, just busy: wait out the rest of the budget in line instead
+                    attempt = DB_CHECKOUT_RETRIES
+                    continue
+                errors = _connection_errors()
+                attempt += 1
+                delay = random.uniform(0, DB_RETRY_BASE * 2 ** (attempt - 1))
+                await asyncio.sleep(min(delay, max(0.0, deadline - time.perf_counter())))
+    checkout_wait.observe(time.perf_counter() - start)
+    try:
+        async with conn:  # commits or rolls back like pool.connection(), the pool keeps the connection
+            yield conn
+    finally:
+        await pool.putconn(conn)
+
+
+async def ping() -> bool:
+    async with connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT 1;")
+            await cur.fetchone()
+            return True
+
+
+def _parse_hours(spec: str) -> list[tuple[int, int]]:
+    ranges = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        start, _, end = part.partition("-")
+        ranges.append((int(start), int(end or start)))
+    return ranges
+
+KEEPALIVE_HOURS = _parse_hours(DB_KEEPALIVE_HOURS)
+
+def in_keepalive_hours(hour: int) -> bool:
+    if not KEEPALIVE_HOURS:
+        return True
+    # a range like 22-4 wraps past midnight
+    return any(start <= hour <= end if start <= end else hour >= start or hour <= end for start, end in KEEPALIVE_HOURS)
+
+
+class PoolKeepAlive:
+    def __init__(self):
+        self.recent_pings = deque(maxlen=20)  # {"at", "ms"} or {"at", "error"}, newest last
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None and DB_KEEPALIVE_INTERVAL > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(DB_KEEPALIVE_INTERVAL * random.uniform(0.9, 1.0))
+            if in_keepalive_hours(time.gmtime().tm_hour):
+                await self.ping_once()
+
+    async def ping_once(self):
+        start = time.perf_counter()
+        try:
+            # check() replaces idle connections that died while compute was away, the ping keeps it from going
+            await pool.check()
+            await ping()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.recent_pings.append({"at": int(time.time()), "error": type(e).__name__})
+            return
+        self.recent_pings.append({"at": int(time.time()), "ms": round((time.perf_counter() - start) * 1000, 1)})
+
+    def stats(self) -> dict:
+        stats = pool.get_stats()
+        return {
+            "min_size": pool.min_size,
+            "max_size": pool.max_size,
+            "pool_size": stats.get("pool_size", 0),
+            "idle": stats.get("pool_available", 0),
+            "waiting": stats.get("requests_waiting", 0),
+            "keepalive": {
+                "running": self.running,
+                "interval": DB_KEEPALIVE_INTERVAL,
+                "hours": DB_KEEPALIVE_HOURS or "all",
+                "recent_pings": list(self.recent_pings),
+            },
+        }
+
+
+keepalive = PoolKeepAlive()
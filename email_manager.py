@@ -1,17 +1,49 @@
-import smtplib, os, uuid, secrets, hashlib
+import smtplib, os, uuid, secrets, hashlib, time, random, asyncio
+from collections import deque, namedtuple
 from email.message import EmailMessage
 from email.utils import formataddr
-from db import pool
+import repository
+from metrics import SMTP_SECONDS
+from timing import span
+from resilience import CircuitBreaker, UpstreamError, UpstreamUnavailable
 from datetime import datetime, timedelta, timezone
 
-BASE_URL = os.environ["BASE_URL"] # so we can switch urls between environments easily
+class EmailNotConfigured(Exception):
+    pass
+
+# so we can switch urls between environments easily. read when a link is made rather than at import,
+# an unset one is refused there (a link without a host is useless) and shows up in /readyz
+def base_url() -> str:
+    return os.environ.get("BASE_URL", "").rstrip("/")
+
+# point these at a local sink (e.g. aiosmtpd on 8025 with SMTP_STARTTLS=0 and an empty EMAIL_PASSWORD) for testing
+SMTP_HOST = os.environ.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1") == "1"
+# socket timeout for each smtp command; it's the deadline too, since cancelling the await wouldn't stop the thread
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", "30"))
+
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "20"))
+# with nothing due the dispatcher sleeps until the earliest retry or this long, whichever is sooner.
+# notify() wakes it for new mail, so this only matters for rows another worker enqueued; keep it well
+# past neon's ~5 minute suspend window so an idle outbox doesn't keep the database awake
+OUTBOX_IDLE_INTERVAL = float(os.environ.get("OUTBOX_IDLE_INTERVAL", "1800"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", "10"))
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", "3600"))
+# a claimed row is left alone by other workers for this long, so a crashed dispatcher's batch gets retried eventually
+OUTBOX_LEASE_SECONDS = int(os.environ.get("OUTBOX_LEASE_SECONDS", "300"))
+
+smtp_breaker = CircuitBreaker("smtp")
+
 # it really doesn't have to be a class but I like it, oh well
 class EmailClient:
     def __init__(self):
         self.sender_email = "rpsnotifcation@gmail.com" # note that there is no "i" in notification
-        self.sender_password = os.environ["EMAIL_PASSWORD"]
+        self.sender_password = os.environ.get("EMAIL_PASSWORD", "")
+        self._server: smtplib.SMTP | None = None
 
-    def send_email(self, recipient_email: str, email_subject: str, email_body: str, html_body: str | None = None):
+    def build_message(self, recipient_email: str, email_subject: str, email_body: str, html_body: str | None = None) -> EmailMessage:
         msg = EmailMessage()
         msg["From"] = formataddr(("RPS Notifications", self.sender_email))
         msg["To"] = recipient_email
@@ -20,91 +52,249 @@ class EmailClient:
 
         if html_body:
             msg.add_alternative(html_body, subtype="html")
+        return msg
 
-        with smtplib.SMTP("smtp.gmail.com", 587, timeout=30) as server:
-            server.ehlo()
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        server.ehlo()
+        if SMTP_STARTTLS:
             server.starttls()
             server.ehlo()
+        if self.sender_password:
             server.login(self.sender_email, self.sender_password)
-            server.send_message(msg)
+        return server
+
+    # reuses the logged-in session as long as the server still answers NOOP
+    def _session(self) -> smtplib.SMTP:
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self.close()
+        self._server = self._connect()
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def send_email(self, recipient_email: str, email_subject: str, email_body: str, html_body: str | None = None):
+        msg = self.build_message(recipient_email, email_subject, email_body, html_body)
+        try:
+            self._session().send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # session died between the NOOP and the send, one more go on a fresh connection
+            self.close()
+            self._session().send_message(msg)
 
     def send_verification(self, recipient_email: str, verification_url: str):
-        subject = "Verify your email"
-        text_body = (
-            "Thanks for making an account for https://rps9.net !\n\n"
-            f"Please verify your email by opening this link:\n{verification_url}\n\n"
-            "If you didn't make an account, please ignore this email."
-        )
-
-        # define palette
-        bg = "#111827"
-        card = "#1F2937"
-        text = "#E5E7EB"
-        secondary = "#9CA3AF"
-        accent = "#3B82F6"
-        preheader = "Verify your email"
-
-        html_body = f"""\
-            <!doctype html>
-            <html>
-            <head>
-                <meta name="viewport" content="width=device-width,initial-scale=1"/>
-                <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
-                <title>{subject}</title>
-                <style>.preheader{{display:none!important;visibility:hidden;opacity:0;height:0;width:0;overflow:hidden;color:transparent}}</style>
-            </head>
-            <body style="margin:0;padding:0;background:{bg};">
-                <span class="preheader">{preheader}</span>
-                <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="background:{bg};padding:24px 12px;">
-                <tr>
-                    <td align="center">
-                    <table role="presentation" cellpadding="0" cellspacing="0" width="600"
-                            style="max-width:600px;width:100%;background:{card};border-radius:14px;box-shadow:0 6px 28px rgba(0,0,0,0.35);">
-                        <tr>
-                        <td style="padding:28px 28px 24px 28px;">
-                            <h1 style="margin:0 0 12px 0;color:{text};font-size:24px;line-height:1.2;font-weight:800;">Verify your email</h1>
-                            <p style="margin:0 0 12px 0;color:{text};line-height:1.55;font-size:16px;">Thanks for making an account for https://rps9.net !</p>
-                            <p style="margin:0 0 12px 0;color:{text};line-height:1.55;font-size:16px;">Please confirm your email by clicking the button below.</p>
-                            <div style="margin-top:20px;">
-                            <a href="{verification_url}"
-                                style="display:inline-block;padding:12px 20px;background:{accent};color:#FFFFFF;
-                                        text-decoration:none;border-radius:10px;font-weight:700;font-size:16px;">
-                                Verify email
-                            </a>
-                            </div>
-                            <p style="margin:24px 0 0 0;color:{secondary};font-size:13px;line-height:1.55;">
-                            If you didn't create an account, you can ignore this email.
-                            </p>
-                        </td>
-                        </tr>
-                    </table>
+        self.send_email(recipient_email, *verification_email(verification_url))
+
+
+def verification_email(verification_url: str) -> tuple[str, str, str]:
+    subject = "Verify your email"
+    text_body = (
+        "Thanks for making an account for https://rps9.net !\n\n"
+        f"Please verify your email by opening this link:\n{verification_url}\n\n"
+        "If you didn't make an account, please ignore this email."
+    )
+
+    # define palette
+    bg = "#111827"
+    card = "#1F2937"
+    text = "#E5E7EB"
+    secondary = "#9CA3AF"
+    accent = "#3B82F6"
+    preheader = "Verify your email"
+
+    html_body = f"""\
+        <!doctype html>
+        <html>
+        <head>
+            <meta name="viewport" content="width=device-width,initial-scale=1"/>
+            <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
+            <title>{subject}</title>
+            <style>.preheader{{display:none!important;visibility:hidden;opacity:0;height:0;width:0;overflow:hidden;color:transparent}}</style>
+        </head>
+        <body style="margin:0;padding:0;background:{bg};">
+            <span class="preheader">{preheader}</span>
+            <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="background:{bg};padding:24px 12px;">
+            <tr>
+                <td align="center">
+                <table role="presentation" cellpadding="0" cellspacing="0" width="600"
+                        style="max-width:600px;width:100%;background:{card};border-radius:14px;box-shadow:0 6px 28px rgba(0,0,0,0.35);">
+                    <tr>
+                    <td style="padding:28px 28px 24px 28px;">
+                        <h1 style="margin:0 0 12px 0;color:{text};font-size:24px;line-height:1.2;font-weight:800;">Verify your email</h1>
+                        <p style="margin:0 0 12px 0;color:{text};line-height:1.55;font-size:16px;">Thanks for making an account for https://rps9.net !</p>
+                        <p style="margin:0 0 12px 0;color:{text};line-height:1.55;font-size:16px;">Please confirm your email by clicking the button below.</p>
+                        <div style="margin-top:20px;">
+                        <a href="{verification_url}"
+                            style="display:inline-block;padding:12px 20px;background:{accent};color:#FFFFFF;
+                                    text-decoration:none;border-radius:10px;font-weight:700;font-size:16px;">
+                            Verify email
+                        </a>
+                        </div>
+                        <p style="margin:24px 0 0 0;color:{secondary};font-size:13px;line-height:1.55;">
+                        If you didn't create an account, you can ignore this email.
+                        </p>
                     </td>
-                </tr>
+                    </tr>
                 </table>
-            </body>
-            </html>
-        """
-        self.send_email(recipient_email, subject, text_body, html_body)
+                </td>
+            </tr>
+            </table>
+        </body>
+        </html>
+    """
+    return subject, text_body, html_body
+
 
+VerificationToken = namedtuple("VerificationToken", "token_id token_hash expires_at url")
 
-def issue_email_verification_link(user_id: int) -> str:
+# only the hash is stored, the raw token only ever exists in the link
+def new_verification_token() -> VerificationToken:
+    base = base_url()
+    if not base:
+        raise EmailNotConfigured("BASE_URL is not set, verification links would have no host")
     token_id = str(uuid.uuid4())
     raw_token = secrets.token_urlsafe(32)
     token_hash = hashlib.sha256(raw_token.encode()).hexdigest()
     expires_at = datetime.now(timezone.utc) + timedelta(minutes=30)
 
-    with pool.connection() as conn, conn.cursor() as cur:
-        cur.execute(
-            "DELETE FROM email_verifications WHERE user_id = %s AND used_at IS NULL",
-            (user_id,)
-        )
-        cur.execute(
-            "INSERT INTO email_verifications (id, user_id, token_hash, expires_at) VALUES (%s, %s, %s, %s)",
-            (token_id, user_id, token_hash, expires_at)
-        )
-
-    base = f"{BASE_URL}/api/auth/verify-email"
-    return f"{base}?token_id={token_id}&token={raw_token}"
+    url = f"{base}/api/auth/verify-email?token_id={token_id}&token={raw_token}"
+    return VerificationToken(token_id, token_hash, expires_at, url)
+
+
+# runs as a task on the app's event loop, the blocking smtplib calls go to a thread
+class OutboxDispatcher:
+    def __init__(self):
+        self.client: EmailClient | None = None
+        self.sent = 0
+        self.failed = 0
+        self.send_latencies = deque(maxlen=100)  # seconds, most recent sends
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.client is not None:
+            await asyncio.to_thread(self.client.close)
+
+    # called after a commit that enqueued mail so it goes out now instead of on the next wake
+    def notify(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                while await self._dispatch_batch() == OUTBOX_BATCH_SIZE:
+                    pass
+                wait = await self._next_wake()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"email outbox: {e}")
+                wait = OUTBOX_BACKOFF_BASE
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    # seconds until the earliest pending row is due, capped at the idle interval.
+    # at least a second, so rows leased by another worker don't turn this into a busy loop
+    async def _next_wake(self) -> float:
+        blocked = smtp_breaker.retry_after()
+        if blocked > 0:
+            return min(max(blocked, 1.0), OUTBOX_IDLE_INTERVAL)
+        due_in = await repository.next_outbox_attempt_in()
+        if due_in is None:
+            return OUTBOX_IDLE_INTERVAL
+        return min(max(due_in, 1.0), OUTBOX_IDLE_INTERVAL)
+
+    async def _dispatch_batch(self) -> int:
+        if smtp_breaker.retry_after() > 0:
+            return 0  # smtp is down, leave the rows for when it's back instead of leasing them
+        rows = await repository.claim_outbox_batch(OUTBOX_LEASE_SECONDS, OUTBOX_BATCH_SIZE)
+        if not rows:
+            return 0
+        if self.client is None:
+            self.client = EmailClient()
+
+        sent_ids, retries, dead = [], [], []
+        for outbox_id, recipient, subject, text_body, html_body, attempts in rows:
+            start = time.perf_counter()
+            try:
+                async with smtp_breaker.guard():
+                    try:
+                        with span("smtp"):
+                            await asyncio.to_thread(self.client.send_email, recipient, subject, text_body, html_body)
+                    except smtplib.SMTPRecipientsRefused as e:
+                        raise UpstreamError("smtp", str(e), trip=False) from e  # a bad address, not a bad server
+            except UpstreamUnavailable as e:
+                # the breaker opened partway through the batch, hand the rest back without using up an attempt
+                retries.append((attempts, "smtp unavailable", e.retry_after, outbox_id))
+                continue
+            except UpstreamError as e:
+                await asyncio.to_thread(self.client.close)
+                error = str(e.__cause__ or e)
+                attempts += 1
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    dead.append((attempts, error, outbox_id))
+                else:
+                    backoff = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+                    retries.append((attempts, error, backoff * random.uniform(0.5, 1.0), outbox_id))
+                continue
+            self.send_latencies.append(time.perf_counter() - start)
+            SMTP_SECONDS.observe(self.send_latencies[-1])
+            sent_ids.append(outbox_id)
+
+        await repository.record_outbox_results(sent_ids, retries, dead)
+
+        self.sent += len(sent_ids)
+        self.failed += len(dead)
+        return len(rows)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def stats(self) -> dict:
+        latencies = sorted(self.send_latencies)
+        return {
+            "running": self.running,
+            "sent": self.sent,
+            "failed": self.failed,
+            "send_latency_ms": {
+                "last": round(self.send_latencies[-1] * 1000, 1) if latencies else None,
+                "p50": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+                "max": round(latencies[-1] * 1000, 1) if latencies else None,
+            },
+        }
+
+
+outbox = OutboxDispatcher()
 
 def main():
     notification_email = EmailClient()
@@ -0,0 +1,55 @@
+import os, json, gzip, hashlib
+from fastapi import Request, Response
+
+# bodies at least this big get compressed when the client accepts it
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+
+try:
+    import brotli  # optional, gzip is used without it
+except ImportError:
+    brotli = None
+
+
+def etag_for(body: bytes) -> str:
+    # weak so the same content matches whether or not it went out compressed
+    return f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def _matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def _encode(body: bytes, accept_encoding: str) -> tuple[bytes, str | None]:
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=5), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=6), "gzip"
+    return body, None
+
+
+# JSON with an ETag and Cache-Control, or a 304 if the client already has it.
+# responses are private: they sit behind admin checks, so only the browser that asked may keep them
+# (a shared cache would hand them to anyone). max_age=0 means it must revalidate every time
+def cached_json(request: Request, content, max_age: int) -> Response:
+    body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+    etag = etag_for(body)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={max_age}" if max_age > 0 else "private, no-cache",
+        "Vary": "Authorization, Accept-Encoding",
+    }
+    if _matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    body, encoding = _encode(body, request.headers.get("accept-encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
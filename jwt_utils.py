@@ -1,25 +1,70 @@
-import os
+import os, uuid, secrets, hashlib
+from collections import namedtuple
 from datetime import datetime, timedelta, timezone
 import jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from db import pool
+import repository
+from cache_utils import TTLCache
+from timing import span, show_server_timing
 
 SECRET_KEY = os.environ.get("SECRET_KEY")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 1440
+# a day until the frontend uses /api/auth/refresh; once it does this can come down to minutes (e.g. 15)
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
 
 security = HTTPBearer(auto_error=False)
 
-def create_access_token(*, username: str, role: str) -> str:
+# (username, iat) -> {"role", "email_verified"}
+# ttl keeps other uvicorn workers from serving a stale role for too long since invalidation is per process
+user_cache = TTLCache(
+	maxsize=int(os.environ.get("USER_CACHE_SIZE", "1024")),
+	ttl=float(os.environ.get("USER_CACHE_TTL", "60")),
+)
+
+# bumped on every invalidation, so a lookup that read the old row before it can't cache it afterwards
+_generations: dict[str, int] = {}
+
+def invalidate_user(username: str) -> int:
+	_generations[username] = _generations.get(username, 0) + 1
+	return user_cache.delete_where(lambda key: key[0] == username)
+
+# returns the token and its exp so callers don't have to decode what they just encoded
+def create_access_token(*, username: str, role: str) -> tuple[str, int]:
 	now = datetime.now(timezone.utc)
+	expires_at = int((now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)).timestamp())
 	payload = {
 		"sub": username,
 		"role": role,
 		"iat": int(now.timestamp()),
-		"exp": int((now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)).timestamp()),
+		"exp": expires_at,
 	}
-	return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+	with span("jwt-encode"):
+		token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+	return token, expires_at
+
+# refresh tokens look like "<row id>.<secret>", the db only ever sees sha256(secret)
+RefreshToken = namedtuple("RefreshToken", "token_id token_hash expires_at value")
+
+def _hash_refresh_secret(secret: str) -> str:
+	return hashlib.sha256(secret.encode()).hexdigest()
+
+def new_refresh_token() -> RefreshToken:
+	token_id = uuid.uuid4()
+	secret = secrets.token_urlsafe(32)
+	expires_at = datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+	return RefreshToken(token_id, _hash_refresh_secret(secret), expires_at, f"{token_id}.{secret}")
+
+# (token_id, token_hash) or None if it isn't shaped like one of ours
+def parse_refresh_token(value: str):
+	token_id, _, secret = value.partition(".")
+	if not secret:
+		return None
+	try:
+		return uuid.UUID(token_id), _hash_refresh_secret(secret)
+	except ValueError:
+		return None
 
 '''
 3 Roles:
@@ -27,11 +72,12 @@ def create_access_token(*, username: str, role: str) -> str:
 	• admin
 	• owner
 '''
-def current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
 	if not credentials or credentials.scheme.lower() != "bearer":
 		raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="missing credentials")
 	try:
-		data = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+		with span("jwt-decode"):
+			data = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
 	except jwt.PyJWTError:
 		raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid or expired token")
 
@@ -39,24 +85,30 @@ def current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
 	if not username:
 		raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token")
 
-	with pool.connection() as conn, conn.cursor() as cur:
-		cur.execute("SELECT role, email_verified FROM users WHERE username = %s", (username,))
-		row = cur.fetchone()
-	if not row:
-		raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="user not found")
-	
-	email_verified = row[1]
-	if not email_verified:
+	cache_key = (username, data.get("iat"))
+	record = user_cache.get(cache_key)
+	if record is None:
+		generation = _generations.get(username, 0)
+		row = await repository.get_user_auth(username)
+		if not row:
+			raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="user not found")
+		record = {"role": row[0], "email_verified": row[1]}
+		if _generations.get(username, 0) == generation:
+			user_cache.set(cache_key, record)
+
+	if not record["email_verified"]:
 		raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="email not verified")
 
-	return {"username": username, "role": row[0]}
+	if record["role"] in ("admin", "owner"):
+		show_server_timing()
+	return {"username": username, "role": record["role"]}
 
-def current_admin(user = Depends(current_user)):
+async def current_admin(user = Depends(current_user)):
 	if user["role"] != "admin" and user["role"] != "owner":
 		raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="admin only")
 	return user
 
-def current_owner(user = Depends(current_user)):
+async def current_owner(user = Depends(current_user)):
 	if user["role"] != "owner":
 		raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="owner only")
 	return user
@@ -0,0 +1,80 @@
+import os, time, random, asyncio
+import repository
+
+# every run wakes the database, so like the outbox and the membership index this stays far past neon's
+# ~5 minute suspend window; nothing here expires on a schedule tighter than hours anyway
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", "21600"))
+MAINTENANCE_BATCH_SIZE = int(os.environ.get("MAINTENANCE_BATCH_SIZE", "500"))
+# caps the work per job per run, whatever's left waits for the next run
+MAINTENANCE_MAX_BATCHES = int(os.environ.get("MAINTENANCE_MAX_BATCHES", "20"))
+VERIFICATION_RETENTION_HOURS = float(os.environ.get("VERIFICATION_RETENTION_HOURS", "24"))
+UNVERIFIED_USER_TTL_DAYS = float(os.environ.get("UNVERIFIED_USER_TTL_DAYS", "7"))
+OUTBOX_RETENTION_DAYS = float(os.environ.get("OUTBOX_RETENTION_DAYS", "7"))
+
+# (name, advisory lock id, (cursor, batch size) -> rows removed); the lock ids just need to stay unique and stable
+JOBS = [
+    ("used_verifications", 1, lambda cur, n: repository.purge_used_verifications(cur, VERIFICATION_RETENTION_HOURS, n)),
+    ("expired_verifications", 2, lambda cur, n: repository.purge_expired_verifications(cur, VERIFICATION_RETENTION_HOURS, n)),
+    ("unverified_users", 3, lambda cur, n: repository.purge_unverified_users(cur, UNVERIFIED_USER_TTL_DAYS, n)),
+    ("finished_outbox", 4, lambda cur, n: repository.purge_finished_outbox(cur, OUTBOX_RETENTION_DAYS, n)),
+    ("expired_refresh_tokens", 5, lambda cur, n: repository.purge_expired_refresh_tokens(cur, n)),
+    ("expired_cache_entries", 6, lambda cur, n: repository.purge_expired_cache_entries(cur, n)),
+]
+
+
+class MaintenanceScheduler:
+    def __init__(self):
+        self.last_runs = {}  # job -> {"removed", "ms", "at"}
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _run(self):
+        # spread workers out so they don't all go for the locks at once
+        await asyncio.sleep(random.uniform(5, 30))
+        while True:
+            await self.run_once()
+            await asyncio.sleep(MAINTENANCE_INTERVAL * random.uniform(0.9, 1.1))
+
+    async def run_once(self):
+        for name, lock_id, purge_batch in JOBS:
+            try:
+                await self._run_job(name, lock_id, purge_batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"maintenance: {name} failed: {e}")
+
+    async def _run_job(self, name: str, lock_id: int, purge_batch):
+        async with repository.advisory_lock(lock_id) as cur:
+            if cur is None:
+                return  # another worker has it
+            start = time.perf_counter()
+            removed = 0
+            # batches keep each statement small; they all commit with the lock when the job is done
+            for _ in range(MAINTENANCE_MAX_BATCHES):
+                deleted = await purge_batch(cur, MAINTENANCE_BATCH_SIZE)
+                removed += deleted
+                if deleted < MAINTENANCE_BATCH_SIZE:
+                    break
+            elapsed_ms = (time.perf_counter() - start) * 1000
+        self.last_runs[name] = {"removed": removed, "ms": round(elapsed_ms, 1), "at": int(time.time())}
+        print(f"maintenance: {name} removed {removed} rows in {elapsed_ms:.1f} ms")
+
+
+scheduler = MaintenanceScheduler()
@@ -0,0 +1,120 @@
+import os, math, time, random, hashlib, asyncio
+import repository
+
+# sized for this many names per filter at this false positive rate; rebuilds grow it if the table outgrows it
+MEMBERSHIP_CAPACITY = int(os.environ.get("MEMBERSHIP_CAPACITY", "100000"))
+MEMBERSHIP_ERROR_RATE = float(os.environ.get("MEMBERSHIP_ERROR_RATE", "0.01"))
+# other workers' signups and the maintenance purges only show up after a rebuild. a rebuild reads the
+# whole users table, so keep this well past neon's ~5 minute suspend window or it keeps compute awake
+MEMBERSHIP_RELOAD_INTERVAL = float(os.environ.get("MEMBERSHIP_RELOAD_INTERVAL", "3600"))
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = MEMBERSHIP_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    # double hashing off one blake2b digest instead of k separate hashes
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+# "definitely free" answers come from memory; "maybe taken" goes to the database to be sure.
+# until the first load finishes everything counts as maybe, so it's never wrong, only slower.
+# a name added by another worker since the last rebuild can read as free, which signup still
+# catches at the INSERT (UniqueViolation) -- the index only saves work, the constraints decide
+class MembershipIndex:
+    def __init__(self):
+        self.usernames: BloomFilter | None = None
+        self.emails: BloomFilter | None = None
+        self.loaded_at: float | None = None
+        self.db_checks = 0
+        self.skipped_checks = 0
+        self._pending: list | None = None  # adds made while a load is running
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"membership index: load failed: {e}")
+            await asyncio.sleep(MEMBERSHIP_RELOAD_INTERVAL * random.uniform(0.9, 1.1))
+
+    # builds fresh filters off to the side and swaps them in, so lookups never see a half-built one
+    async def load(self):
+        capacity = max(MEMBERSHIP_CAPACITY, 2 * (self.usernames.count if self.usernames else 0))
+        usernames, emails = BloomFilter(capacity), BloomFilter(capacity)
+        self._pending = []
+        try:
+            async for username, email in repository.iter_identities():
+                usernames.add(username)
+                emails.add(email)
+            # signups that landed while we were reading may be missing from the cursor's snapshot
+            for username, email in self._pending:
+                usernames.add(username)
+                emails.add(email)
+        finally:
+            self._pending = None
+        self.usernames, self.emails, self.loaded_at = usernames, emails, time.time()
+
+    def add(self, username: str, email: str):
+        if self._pending is not None:
+            self._pending.append((username, email))
+        if self.usernames is not None:
+            self.usernames.add(username)
+            self.emails.add(email)
+
+    def _maybe(self, bloom: BloomFilter | None, value: str | None) -> bool:
+        return value is not None and (bloom is None or value in bloom)
+
+    # (username taken, email taken); values must already be normalized like signup does
+    async def taken(self, username: str | None, email: str | None) -> tuple[bool, bool]:
+        maybe_username = self._maybe(self.usernames, username)
+        maybe_email = self._maybe(self.emails, email)
+        if not maybe_username and not maybe_email:
+            self.skipped_checks += 1
+            return False, False
+        self.db_checks += 1
+        row = await repository.find_taken(username if maybe_username else None, email if maybe_email else None)
+        return bool(row[0]), bool(row[1])
+
+    def stats(self) -> dict:
+        return {
+            "loaded_at": self.loaded_at,
+            "usernames": self.usernames.count if self.usernames else None,
+            "emails": self.emails.count if self.emails else None,
+            "db_checks": self.db_checks,
+            "skipped_checks": self.skipped_checks,
+        }
+
+
+membership = MembershipIndex()
@@ -1,23 +1,149 @@
-from openai import OpenAI
-import os
-      
+import os, json, time, asyncio
+from metrics import OPENAI_SECONDS
+from timing import span
+from resilience import CircuitBreaker, UpstreamError, parse_retry_after
+
+# the whole non-streamed completion, and for streams the wait for the response and then between chunks
+OPENAI_DEADLINE = float(os.environ.get('OPENAI_DEADLINE', '60'))
+OPENAI_STREAM_IDLE_DEADLINE = float(os.environ.get('OPENAI_STREAM_IDLE_DEADLINE', '20'))
+OPENAI_DEFAULT_BACKOFF = float(os.environ.get('OPENAI_DEFAULT_BACKOFF', '10'))
+
+breaker = CircuitBreaker('openai')
+
+# one client (and connection pool) for the whole app, OPENAI_BASE_URL can point it at a local mock server.
+# the sdk is slow to import, so that waits until the first songrecs call
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        from openai import AsyncOpenAI
+        # the breaker and deadlines decide when to give up, not the sdk's own retries
+        _client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0, timeout=OPENAI_DEADLINE)
+    return _client
+
+def is_configured() -> bool:
+    return bool(os.getenv('OPENAI_API_KEY'))
+
+# sdk errors carry the http response; a 429 backs off every request, other 4xx aren't the upstream's fault
+def _upstream_error(e: Exception) -> UpstreamError | None:
+    status_code = getattr(e, 'status_code', None)
+    if status_code is None:
+        return None
+    if status_code == 429:
+        response = getattr(e, 'response', None)
+        retry_after = parse_retry_after(response.headers.get('retry-after') if response is not None else None)
+        breaker.defer(retry_after or OPENAI_DEFAULT_BACKOFF)
+    return UpstreamError('openai', f'returned {status_code}', trip=status_code >= 500)
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
 
 class chatManager:
-    
+
     def __init__(self, model):
         self.model = model
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        self.client = get_client()
 
 
     # Asks a question with no chat history
-    def chat(self, prompt=""):
+    async def chat(self, prompt=""):
         chat_question = [{"role": "user", "content": prompt}]
 
-        completion = self.client.chat.completions.create(
-          model=self.model,
-          messages=chat_question
-        )
+        async with breaker.guard(OPENAI_DEADLINE):
+            with OPENAI_SECONDS.time("chat"), span("openai"):
+                try:
+                    completion = await self.client.chat.completions.create(
+                      model=self.model,
+                      messages=chat_question
+                    )
+                except Exception as e:
+                    raise _upstream_error(e) or e
 
         openai_answer = completion.choices[0].message.content
         return openai_answer
 
+    # Same as chat but yields the answer as it's generated
+    async def stream_chat(self, prompt=""):
+        chat_question = [{"role": "user", "content": prompt}]
+
+        start = time.perf_counter()
+        # no overall deadline here, a long answer that keeps coming is fine; a stalled one isn't
+        async with breaker.guard():
+            try:
+                async with asyncio.timeout(OPENAI_STREAM_IDLE_DEADLINE):
+                    with span("openai"):  # time to the response starting, the rest streams after the headers
+                        stream = await self.client.chat.completions.create(
+                          model=self.model,
+                          messages=chat_question,
+                          stream=True
+                        )
+            except Exception as e:
+                raise _upstream_error(e) or e
+
+            chunks = stream.__aiter__()
+            first = True
+            while True:
+                try:
+                    async with asyncio.timeout(OPENAI_STREAM_IDLE_DEADLINE):
+                        chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    break
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first:
+                        OPENAI_SECONDS.observe(time.perf_counter() - start, "stream_first_token")
+                        first = False
+                    yield chunk.choices[0].delta.content
+        OPENAI_SECONDS.observe(time.perf_counter() - start, "stream")
+
+
+# Incremental parser for a streamed JSON array of objects: feed() it text as it arrives
+# and it hands back each top level object as soon as its closing brace shows up.
+# Anything outside of objects (the [ ] , or a ```json fence) is skipped.
+class JSONObjectStream:
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.start_depth = None
+        self.buffer = []
+
+    def feed(self, text: str) -> list[dict]:
+        done = []
+        for ch in text:
+            if self.start_depth is not None:
+                self.buffer.append(ch)
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+
+            if ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                if self.start_depth is None:
+                    self.start_depth = self.depth
+                    self.buffer = ["{"]
+                self.depth += 1
+            elif ch == "[":
+                self.depth += 1
+            elif ch in "}]":
+                self.depth = max(0, self.depth - 1)
+                if ch == "}" and self.start_depth is not None and self.depth == self.start_depth:
+                    try:
+                        done.append(json.loads("".join(self.buffer)))
+                    except ValueError:
+                        pass
+                    self.start_depth = None
+                    self.buffer = []
+        return done
@@ -0,0 +1,108 @@
+import os, time, math
+from collections import OrderedDict
+from fastapi import HTTPException, Request, status
+import repository
+
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "memory")  # memory or postgres (shared across workers)
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get("RATE_LIMIT_MAX_BUCKETS", "50000"))
+RATE_LIMIT_SWEEP_INTERVAL = float(os.environ.get("RATE_LIMIT_SWEEP_INTERVAL", "60"))
+# how many proxies (nginx) sit in front of us and append to X-Forwarded-For
+TRUSTED_PROXY_COUNT = int(os.environ.get("TRUSTED_PROXY_COUNT", "1"))
+
+# "count/seconds": a bucket holds `count` tokens and refills all of them over `seconds`
+def _rule(env: str, default: str) -> tuple[float, float]:
+    count, seconds = os.environ.get(env, default).split("/")
+    return float(count), float(count) / float(seconds)
+
+RULES = {
+    "signin:ip": _rule("RATE_LIMIT_SIGNIN_IP", "20/60"),
+    "signin:user": _rule("RATE_LIMIT_SIGNIN_USER", "5/300"),
+    "signup:ip": _rule("RATE_LIMIT_SIGNUP_IP", "5/600"),
+    # live form validation calls this per keystroke (debounced), but it also says which emails have accounts
+    "availability:ip": _rule("RATE_LIMIT_AVAILABILITY_IP", "60/60"),
+}
+
+
+def client_ip(request: Request) -> str:
+    # nginx appends the address it saw, so count back from the right; anything further left is client supplied
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded and TRUSTED_PROXY_COUNT > 0:
+        hops = [h.strip() for h in forwarded.split(",") if h.strip()]
+        if hops:
+            return hops[-min(TRUSTED_PROXY_COUNT, len(hops))]
+    return request.client.host if request.client else "unknown"
+
+
+class MemoryBucketStore:
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets: OrderedDict = OrderedDict()  # key -> [tokens, updated_at, full_after]
+        self._last_sweep = time.monotonic()
+
+    # returns seconds to wait, 0 if the tokens were taken
+    async def take(self, key: str, capacity: float, rate: float, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        self._maybe_sweep(now)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [capacity, now, now]
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] < cost:
+            return (cost - bucket[0]) / rate
+        bucket[0] -= cost
+        bucket[2] = now + (capacity - bucket[0]) / rate
+        return 0.0
+
+    # a bucket that has refilled completely is the same as no bucket, so drop it
+    def _maybe_sweep(self, now: float):
+        if now - self._last_sweep < RATE_LIMIT_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for key in [k for k, b in self._buckets.items() if b[2] <= now]:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class PostgresBucketStore:
+    def __init__(self):
+        self._last_sweep = time.monotonic()
+        self._longest_refill = max(capacity / rate for capacity, rate in RULES.values())
+
+    async def take(self, key: str, capacity: float, rate: float, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        if now - self._last_sweep >= RATE_LIMIT_SWEEP_INTERVAL:
+            self._last_sweep = now
+            await repository.delete_idle_rate_limit_buckets(self._longest_refill)
+
+        tokens, allowed = await repository.take_rate_limit_tokens(key, capacity, rate, cost)
+        return 0.0 if allowed else (cost - tokens) / rate
+
+
+class RateLimiter:
+    def __init__(self, store):
+        self.store = store
+
+    # checks each (rule, value) in order and raises 429 on the first empty bucket
+    async def check(self, *limits: tuple[str, str]):
+        for rule, value in limits:
+            capacity, rate = RULES[rule]
+            wait = await self.store.take(f"{rule}:{value}", capacity, rate)
+            if wait > 0:
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="too many attempts, slow down",
+                    headers={"Retry-After": str(max(1, math.ceil(wait)))},
+                )
+
+
+limiter = RateLimiter(PostgresBucketStore() if RATE_LIMIT_STORE == "postgres" else MemoryBucketStore())
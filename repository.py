@@ -0,0 +1,467 @@
+import os
+from contextlib import asynccontextmanager
+from db import connection
+from timing import span
+
+# every query in the app lives here, one statement (and one checkout) per operation where possible.
+# prepare=True has psycopg use server-side prepared statements on each pooled connection;
+# set DB_PREPARE=0 if the database sits behind a pooler that can't handle them.
+PREPARE = os.environ.get("DB_PREPARE", "1") == "1"
+
+
+async def _fetchone(sql: str, params: tuple):
+    async with connection() as conn, conn.cursor() as cur:
+        with span("db-query"):
+            await cur.execute(sql, params, prepare=PREPARE)
+            return await cur.fetchone()
+
+async def _fetchall(sql: str, params: tuple):
+    async with connection() as conn, conn.cursor() as cur:
+        with span("db-query"):
+            await cur.execute(sql, params, prepare=PREPARE)
+            return await cur.fetchall()
+
+async def _execute(sql: str, params: tuple) -> int:
+    async with connection() as conn, conn.cursor() as cur:
+        with span("db-query"):
+            await cur.execute(sql, params, prepare=PREPARE)
+            return cur.rowcount
+
+# for statements that have to run on a connection the caller already holds (the maintenance lock's)
+async def _execute_on(cur, sql: str, params: tuple) -> int:
+    with span("db-query"):
+        await cur.execute(sql, params, prepare=PREPARE)
+        return cur.rowcount
+
+
+# ---- users ----
+
+async def get_user_auth(username: str):
+    return await _fetchone("SELECT role, email_verified FROM users WHERE username = %s", (username,))
+
+async def get_user_credentials(username: str):
+    return await _fetchone("SELECT password_hash, role, email_verified FROM users WHERE username = %s", (username,))
+
+async def update_password_hash(username: str, new_hash: str, old_hash: str) -> bool:
+    # only swap if nobody changed the hash in the meantime
+    return await _execute(
+        "UPDATE users SET password_hash = %s WHERE username = %s AND password_hash = %s",
+        (new_hash, username, old_hash),
+    ) == 1
+
+# user, verification token, first refresh token and the queued verification email in one round trip
+async def create_user(username: str, email: str, password_hash: str, token, refresh, mail: tuple[str, str, str]) -> int:
+    subject, text_body, html_body = mail
+    row = await _fetchone(
+        """
+        WITH new_user AS (
+            INSERT INTO users (username, email, email_verified, password_hash)
+            VALUES (%s, %s, FALSE, %s)
+            RETURNING id
+        ), new_token AS (
+            INSERT INTO email_verifications (id, user_id, token_hash, expires_at)
+            VALUES (%s, (SELECT id FROM new_user), %s, %s)
+        ), new_refresh AS (
+            INSERT INTO refresh_tokens (id, user_id, family_id, token_hash, expires_at)
+            VALUES (%s, (SELECT id FROM new_user), %s, %s, %s)
+        ), new_mail AS (
+            INSERT INTO email_outbox (recipient, subject, text_body, html_body)
+            VALUES (%s, %s, %s, %s)
+        )
+        SELECT id FROM new_user
+        """,
+        (
+            username, email, password_hash,
+            token.token_id, token.token_hash, token.expires_at,
+            refresh.token_id, refresh.token_id, refresh.token_hash, refresh.expires_at,
+            email, subject, text_body, html_body,
+        ),
+    )
+    return row[0]
+
+# returns (previous_role, changed) or None if the user doesn't exist
+async def set_role(username: str, role: str):
+    return await _fetchone(
+        """
+        WITH target AS (
+            SELECT id, role FROM users WHERE username = %s
+        ), changed AS (
+            UPDATE users SET role = %s
+            FROM target
+            WHERE users.id = target.id AND target.role <> %s
+            RETURNING users.id
+        )
+        SELECT target.role, EXISTS (SELECT 1 FROM changed) FROM target
+        """,
+        (username, role, role),
+    )
+
+# applies many (username, role) pairs in one statement; a username listed twice keeps its last role.
+# returns (username, role, previous_role or None if missing, changed) in input order
+async def set_roles(usernames: list[str], roles: list[str]) -> list:
+    return await _fetchall(
+        """
+        WITH input AS (
+            SELECT DISTINCT ON (username) username, role, ord
+            FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS t(username, role, ord)
+            ORDER BY username, ord DESC
+        ), target AS (
+            SELECT users.id, users.username, users.role AS previous_role, input.role
+            FROM input JOIN users ON users.username = input.username
+        ), changed AS (
+            UPDATE users SET role = target.role
+            FROM target
+            WHERE users.id = target.id AND target.previous_role <> target.role
+            RETURNING users.username
+        )
+        SELECT input.username, input.role, target.previous_role, changed.username IS NOT NULL
+        FROM input
+        LEFT JOIN target ON target.username = input.username
+        LEFT JOIN changed ON changed.username = input.username
+        ORDER BY input.ord
+        """,
+        (usernames, roles),
+    )
+
+# keyset pagination on id through a server-side cursor, so a full export never holds more than one fetch in memory
+async def iter_users(after_id: int, limit: int | None, role: str | None, verified: bool | None, fetch_size: int = 500):
+    where = ["id > %s"]
+    params = [after_id]
+    if role is not None:
+        where.append("role = %s")
+        params.append(role)
+    if verified is not None:
+        where.append("email_verified = %s")
+        params.append(verified)
+    sql = f"SELECT id, username, email, role, email_verified, created_at FROM users WHERE {' AND '.join(where)} ORDER BY id"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+
+    async with connection() as conn, conn.cursor(name="iter_users") as cur:
+        cur.itersize = fetch_size
+        await cur.execute(sql, params)
+        async for row in cur:
+            yield row
+
+# every username and email, for loading the membership index
+async def iter_identities(fetch_size: int = 5000):
+    async with connection() as conn, conn.cursor(name="iter_identities") as cur:
+        cur.itersize = fetch_size
+        await cur.execute("SELECT username, lower(email) FROM users")
+        async for row in cur:
+            yield row
+
+# exact check behind the membership index: (username taken, email taken); None never matches
+async def find_taken(username: str | None, email: str | None) -> tuple[bool, bool]:
+    return await _fetchone(
+        """
+        SELECT
+            EXISTS (SELECT 1 FROM users WHERE username = %(username)s),
+            EXISTS (SELECT 1 FROM users WHERE lower(email) = %(email)s)
+        """,
+        {"username": username, "email": email},
+    )
+
+
+# ---- refresh tokens ----
+
+# starts a new family, e.g. on signin
+async def insert_refresh_token(username: str, refresh) -> None:
+    await _execute(
+        """
+        INSERT INTO refresh_tokens (id, user_id, family_id, token_hash, expires_at)
+        SELECT %s, id, %s, %s, %s FROM users WHERE username = %s
+        """,
+        (refresh.token_id, refresh.token_id, refresh.token_hash, refresh.expires_at, username),
+    )
+
+# revokes the presented token and issues its replacement in the same family, all against the primary key.
+# returns (username, role, email_verified) or None if the token is unknown, used, revoked or expired
+async def rotate_refresh_token(token_id, token_hash: str, refresh):
+    return await _fetchone(
+        """
+        WITH used AS (
+            UPDATE refresh_tokens SET revoked_at = now()
+            WHERE id = %s AND token_hash = %s AND revoked_at IS NULL AND expires_at > now()
+            RETURNING user_id, family_id
+        ), issued AS (
+            INSERT INTO refresh_tokens (id, user_id, family_id, token_hash, expires_at)
+            SELECT %s, user_id, family_id, %s, %s FROM used
+        )
+        SELECT users.username, users.role, users.email_verified
+        FROM used JOIN users ON users.id = used.user_id
+        """,
+        (token_id, token_hash, refresh.token_id, refresh.token_hash, refresh.expires_at),
+    )
+
+# an already rotated token showing up again means it leaked, so kill the whole family.
+# the grace window keeps two tabs refreshing at the same moment from logging each other out
+async def revoke_reused_refresh_family(token_id, token_hash: str, grace_seconds: int = 10) -> int:
+    return await _execute(
+        """
+        UPDATE refresh_tokens SET revoked_at = now()
+        WHERE revoked_at IS NULL AND family_id = (
+            SELECT family_id FROM refresh_tokens
+            WHERE id = %s AND token_hash = %s AND revoked_at < now() - make_interval(secs => %s)
+        )
+        """,
+        (token_id, token_hash, grace_seconds),
+    )
+
+async def revoke_refresh_family(token_id, token_hash: str) -> int:
+    return await _execute(
+        """
+        UPDATE refresh_tokens SET revoked_at = now()
+        WHERE revoked_at IS NULL AND family_id = (
+            SELECT family_id FROM refresh_tokens WHERE id = %s AND token_hash = %s
+        )
+        """,
+        (token_id, token_hash),
+    )
+
+
+# ---- email verification ----
+
+# drops any unused tokens for the user and stores the new one, for resends
+async def replace_verification(user_id: int, token) -> None:
+    await _execute(
+        """
+        WITH cleared AS (
+            DELETE FROM email_verifications WHERE user_id = %s AND used_at IS NULL
+        )
+        INSERT INTO email_verifications (id, user_id, token_hash, expires_at) VALUES (%s, %s, %s, %s)
+        """,
+        (user_id, token.token_id, user_id, token.token_hash, token.expires_at),
+    )
+
+# marks the token used and the user verified in one conditional update, returns the username or None
+async def consume_verification(token_id: str, token_hash: str):
+    row = await _fetchone(
+        """
+        WITH consumed AS (
+            UPDATE email_verifications SET used_at = now()
+            WHERE id = %s AND token_hash = %s AND used_at IS NULL AND expires_at > now()
+            RETURNING user_id
+        )
+        UPDATE users SET email_verified = TRUE
+        FROM consumed
+        WHERE users.id = consumed.user_id
+        RETURNING users.username
+        """,
+        (token_id, token_hash),
+    )
+    return row[0] if row else None
+
+# only used to pick the right error page after consume_verification misses
+async def get_verification(token_id: str):
+    return await _fetchone(
+        "SELECT token_hash, expires_at, used_at FROM email_verifications WHERE id = %s",
+        (token_id,),
+    )
+
+
+# ---- email outbox ----
+
+# leases up to batch_size due rows; other workers skip them until the lease runs out
+async def claim_outbox_batch(lease_seconds: int, batch_size: int) -> list:
+    return await _fetchall(
+        """
+        UPDATE email_outbox SET next_attempt_at = now() + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE sent_at IS NULL AND failed_at IS NULL AND next_attempt_at <= now()
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, recipient, subject, text_body, html_body, attempts
+        """,
+        (lease_seconds, batch_size),
+    )
+
+async def outbox_queue_depth() -> int:
+    row = await _fetchone("SELECT count(*) FROM email_outbox WHERE sent_at IS NULL AND failed_at IS NULL", ())
+    return row[0]
+
+# seconds until the earliest pending row is due (negative if one is overdue), None with nothing pending.
+# min() over the partial pending index is a single index probe
+async def next_outbox_attempt_in() -> float | None:
+    row = await _fetchone(
+        "SELECT EXTRACT(EPOCH FROM min(next_attempt_at) - now()) FROM email_outbox WHERE sent_at IS NULL AND failed_at IS NULL",
+        (),
+    )
+    return float(row[0]) if row[0] is not None else None
+
+# sent: [id], retries: [(attempts, error, backoff_seconds, id)], dead: [(attempts, error, id)]
+async def record_outbox_results(sent: list, retries: list, dead: list) -> None:
+    async with connection() as conn, conn.cursor() as cur:
+        if sent:
+            await cur.execute("UPDATE email_outbox SET sent_at = now() WHERE id = ANY(%s)", (sent,), prepare=PREPARE)
+        if retries:
+            await cur.executemany(
+                "UPDATE email_outbox SET attempts = %s, last_error = %s, next_attempt_at = now() + make_interval(secs => %s) WHERE id = %s",
+                retries,
+            )
+        if dead:
+            await cur.executemany(
+                "UPDATE email_outbox SET attempts = %s, last_error = %s, failed_at = now() WHERE id = %s",
+                dead,
+            )
+
+
+# ---- rate limiting ----
+
+# refills the bucket for the time since it was last touched and takes `cost` if there's enough;
+# `allowed` is computed from the old row so it says whether this call got its tokens
+async def take_rate_limit_tokens(key: str, capacity: float, rate: float, cost: float):
+    return await _fetchone(
+        """
+        INSERT INTO rate_limit_buckets AS b (key, tokens, allowed, updated_at)
+        VALUES (%(key)s, %(capacity)s - %(cost)s, TRUE, now())
+        ON CONFLICT (key) DO UPDATE SET
+            allowed = LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * %(rate)s) >= %(cost)s,
+            tokens = LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * %(rate)s)
+                - CASE WHEN LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM now() - b.updated_at) * %(rate)s) >= %(cost)s
+                       THEN %(cost)s ELSE 0 END,
+            updated_at = now()
+        RETURNING tokens, allowed
+        """,
+        {"key": key, "capacity": float(capacity), "rate": float(rate), "cost": float(cost)},
+    )
+
+# a bucket idle this long has refilled completely, so dropping it changes nothing
+async def delete_idle_rate_limit_buckets(idle_seconds: float) -> int:
+    return await _execute(
+        "DELETE FROM rate_limit_buckets WHERE updated_at < now() - make_interval(secs => %s)",
+        (idle_seconds,),
+    )
+
+
+# ---- shared cache ----
+# values are json text, compare_and_set compares that text exactly
+
+async def cache_get(key: str):
+    row = await _fetchone("SELECT value, EXTRACT(EPOCH FROM expires_at) FROM cache_entries WHERE key = %s AND expires_at > now()", (key,))
+    return None if row is None else (row[0], float(row[1]))
+
+async def cache_set(key: str, value: str, ttl: float):
+    await _execute(
+        """
+        INSERT INTO cache_entries (key, value, expires_at) VALUES (%s, %s, now() + make_interval(secs => %s))
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+        """,
+        (key, value, ttl),
+    )
+
+# expected None means "only if there's no live entry"; an expired row counts as absent
+async def cache_compare_and_set(key: str, expected: str | None, value: str, ttl: float) -> bool:
+    if expected is None:
+        return await _execute(
+            """
+            INSERT INTO cache_entries AS c (key, value, expires_at) VALUES (%s, %s, now() + make_interval(secs => %s))
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            WHERE c.expires_at <= now()
+            """,
+            (key, value, ttl),
+        ) == 1
+    return await _execute(
+        "UPDATE cache_entries SET value = %s, expires_at = now() + make_interval(secs => %s) WHERE key = %s AND value = %s AND expires_at > now()",
+        (value, ttl, key, expected),
+    ) == 1
+
+async def cache_delete(key: str):
+    await _execute("DELETE FROM cache_entries WHERE key = %s", (key,))
+
+async def purge_expired_cache_entries(cur, batch_size: int) -> int:
+    return await _execute_on(
+        cur,
+        """
+        DELETE FROM cache_entries WHERE key IN (
+            SELECT key FROM cache_entries WHERE expires_at < now() LIMIT %s
+        )
+        """,
+        (batch_size,),
+    )
+
+
+# ---- maintenance ----
+
+MAINTENANCE_LOCK_NAMESPACE = 7341
+
+# transaction-level advisory lock, so only one worker runs a given job at a time. yields the cursor that
+# holds it (None if another worker does) and the purges below run on it: one connection per job, and the
+# lock and the deletes commit or roll back together when connection() exits, even if the job is cancelled
+@asynccontextmanager
+async def advisory_lock(lock_id: int):
+    async with connection() as conn, conn.cursor() as cur:
+        await cur.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (MAINTENANCE_LOCK_NAMESPACE, lock_id))
+        yield cur if (await cur.fetchone())[0] else None
+
+async def purge_used_verifications(cur, older_than_hours: float, batch_size: int) -> int:
+    return await _execute_on(
+        cur,
+        """
+        DELETE FROM email_verifications WHERE id IN (
+            SELECT id FROM email_verifications
+            WHERE used_at IS NOT NULL AND used_at < now() - make_interval(secs => %s)
+            LIMIT %s
+        )
+        """,
+        (older_than_hours * 3600, batch_size),
+    )
+
+async def purge_expired_verifications(cur, older_than_hours: float, batch_size: int) -> int:
+    return await _execute_on(
+        cur,
+        """
+        DELETE FROM email_verifications WHERE id IN (
+            SELECT id FROM email_verifications
+            WHERE expires_at < now() - make_interval(secs => %s)
+            LIMIT %s
+        )
+        """,
+        (older_than_hours * 3600, batch_size),
+    )
+
+# plain users that never verified, along with their leftover tokens
+async def purge_unverified_users(cur, older_than_days: float, batch_size: int) -> int:
+    return await _execute_on(
+        cur,
+        """
+        WITH doomed AS (
+            SELECT id FROM users
+            WHERE NOT email_verified AND role = 'user' AND created_at < now() - make_interval(secs => %s)
+            ORDER BY created_at
+            LIMIT %s
+        ), tokens AS (
+            DELETE FROM email_verifications WHERE user_id IN (SELECT id FROM doomed)
+        )
+        DELETE FROM users WHERE id IN (SELECT id FROM doomed)
+        """,
+        (older_than_days * 86400, batch_size),
+    )
+
+async def purge_finished_outbox(cur, older_than_days: float, batch_size: int) -> int:
+    return await _execute_on(
+        cur,
+        """
+        DELETE FROM email_outbox WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE (sent_at IS NOT NULL OR failed_at IS NOT NULL) AND created_at < now() - make_interval(secs => %s)
+            LIMIT %s
+        )
+        """,
+        (older_than_days * 86400, batch_size),
+    )
+
+async def purge_expired_refresh_tokens(cur, batch_size: int) -> int:
+    return await _execute_on(
+        cur,
+        """
+        DELETE FROM refresh_tokens WHERE id IN (
+            SELECT id FROM refresh_tokens WHERE expires_at < now() LIMIT %s
+        )
+        """,
+        (batch_size,),
+    )
@@ -0,0 +1,165 @@
+import os, time, asyncio
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from metrics import register_collector
+
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", "30"))
+# upper bound on a Retry-After we'll honor, so one odd header can't switch an upstream off for hours
+MAX_RETRY_AFTER = float(os.environ.get("MAX_RETRY_AFTER", "300"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+# raised without calling the upstream: its breaker is open or it told us to back off
+class UpstreamUnavailable(Exception):
+    def __init__(self, upstream: str, retry_after: float, reason: str):
+        super().__init__(f"{upstream} unavailable ({reason})")
+        self.upstream = upstream
+        self.retry_after = retry_after
+        self.reason = reason  # "circuit_open" or "rate_limited"
+
+
+# the upstream was called and failed (timeout, connection error, bad response)
+class UpstreamError(Exception):
+    def __init__(self, upstream: str, detail: str, trip: bool = True):
+        super().__init__(f"{upstream}: {detail}")
+        self.upstream = upstream
+        self.detail = detail
+        self.trip = trip  # False for answers that don't say anything about the upstream's health, like a 400
+
+
+# seconds from a Retry-After header (delta-seconds or an http date), None if missing or unreadable
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+# one per upstream, shared by every request in this worker.
+# closed: calls go through; `failure_threshold` failures in a row open it.
+# open: calls fail fast until `reset_seconds` pass, then one trial call goes through (half open)
+# and its result closes or reopens it. defer() is the Retry-After gate and blocks calls the same way.
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._state = CLOSED
+        self._open_until = 0.0
+        self._deferred_until = 0.0
+        self._trial_running = False
+        BREAKERS[name] = self
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() >= self._open_until:
+            return HALF_OPEN
+        return self._state
+
+    def retry_after(self) -> float:
+        now = time.monotonic()
+        wait = self._deferred_until - now
+        if self._state == OPEN:
+            wait = max(wait, self._open_until - now)
+        return max(wait, 0.0)
+
+    def defer(self, seconds: float):
+        self._deferred_until = max(self._deferred_until, time.monotonic() + seconds)
+
+    # fails fast before committing to something (like a streamed 200) without using up the half open trial
+    def raise_if_blocked(self):
+        wait = self.retry_after()
+        if wait > 0:
+            raise UpstreamUnavailable(self.name, wait, "rate_limited" if time.monotonic() < self._deferred_until else "circuit_open")
+
+    def before_call(self):
+        now = time.monotonic()
+        if now < self._deferred_until:
+            self.rejected += 1
+            raise UpstreamUnavailable(self.name, self._deferred_until - now, "rate_limited")
+        if self._state == OPEN:
+            if now < self._open_until or self._trial_running:
+                self.rejected += 1
+                raise UpstreamUnavailable(self.name, max(self._open_until - now, 1.0), "circuit_open")
+            self._trial_running = True
+
+    def record_success(self):
+        self.failures = 0
+        self._state = CLOSED
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_running or self.failures >= self.failure_threshold:
+            if self._state != OPEN:
+                self.opened += 1
+            self._state = OPEN
+            self._open_until = time.monotonic() + self.reset_seconds
+        self._trial_running = False
+
+    # wraps one upstream call: fails fast while blocked, applies the deadline and records the outcome.
+    # anything that escapes comes out as UpstreamError so callers only have two exceptions to map
+    @asynccontextmanager
+    async def guard(self, deadline: float | None = None):
+        self.before_call()
+        try:
+            async with asyncio.timeout(deadline):
+                yield
+        except UpstreamError as e:
+            if e.trip:
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except TimeoutError as e:
+            self.record_failure()
+            raise UpstreamError(self.name, "timed out") from e
+        except Exception as e:
+            self.record_failure()
+            raise UpstreamError(self.name, type(e).__name__) from e
+        except BaseException:
+            # cancelled (client went away), says nothing about the upstream
+            self._trial_running = False
+            raise
+        else:
+            self.record_success()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_after": round(self.retry_after(), 1),
+        }
+
+
+BREAKERS: dict[str, CircuitBreaker] = {}
+
+
+def breaker_states() -> dict:
+    return {name: breaker.stats() for name, breaker in BREAKERS.items()}
+
+
+@register_collector
+def _breaker_gauges():
+    samples = []
+    for name, breaker in BREAKERS.items():
+        state = breaker.state
+        for s in (CLOSED, OPEN, HALF_OPEN):
+            samples.append(("upstream_breaker_state", {"upstream": name, "state": s}, 1 if state == s else 0))
+        samples.append(("upstream_breaker_opened", {"upstream": name}, breaker.opened))
+        samples.append(("upstream_breaker_rejected", {"upstream": name}, breaker.rejected))
+        samples.append(("upstream_retry_after_seconds", {"upstream": name}, breaker.retry_after()))
+    return samples
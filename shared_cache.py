@@ -0,0 +1,192 @@
+import os, json, mmap, time, struct, hashlib, tempfile, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import repository
+
+# memory: per process (the default, one worker)
+# shm: an mmap'd slot table every worker on the host opens
+# postgres: the cache_entries table (sql/005_cache_entries.sql), shared by every host
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "memory")
+CACHE_MEMORY_MAX_ENTRIES = int(os.environ.get("CACHE_MEMORY_MAX_ENTRIES", "4096"))
+CACHE_SHM_PATH = os.environ.get("CACHE_SHM_PATH") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "rps9-cache"
+)
+CACHE_SHM_SLOTS = int(os.environ.get("CACHE_SHM_SLOTS", "1024"))
+CACHE_SHM_SLOT_SIZE = int(os.environ.get("CACHE_SHM_SLOT_SIZE", "4096"))
+
+
+# values go through json so every backend stores (and compares) the same text
+def _encode(value) -> str:
+    return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+
+# get / set / compare_and_set / delete; expected=None in compare_and_set means "only if absent"
+class MemoryCacheBackend:
+    name = "memory"
+    shared = False
+
+    def __init__(self, max_entries: int = CACHE_MEMORY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, text)
+
+    def _live(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._data[key]
+            return None
+        return entry[1]
+
+    def _store(self, key: str, text: str, ttl: float):
+        self._data[key] = (time.time() + ttl, text)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def get(self, key: str):
+        text = self._live(key)
+        return None if text is None else json.loads(text)
+
+    async def set(self, key: str, value, ttl: float):
+        self._store(key, _encode(value), ttl)
+
+    async def compare_and_set(self, key: str, expected, value, ttl: float) -> bool:
+        if self._live(key) != (None if expected is None else _encode(expected)):
+            return False
+        self._store(key, _encode(value), ttl)
+        return True
+
+    async def delete(self, key: str):
+        self._data.pop(key, None)
+
+
+class SharedMemoryCacheBackend:
+    name = "shm"
+    shared = True
+
+    MAGIC = b"RPSC"
+    HEADER = struct.Struct("<4sII")  # magic, slots, slot size
+    SLOT = struct.Struct("<dHI")     # expires_at (wall clock), key length, value length
+    PROBES = 8
+
+    def __init__(self, path: str = CACHE_SHM_PATH, slots: int = CACHE_SHM_SLOTS, slot_size: int = CACHE_SHM_SLOT_SIZE):
+        import fcntl  # unix only, like /dev/shm
+        self._fcntl = fcntl
+        self.slots = slots
+        self.slot_size = slot_size
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.HEADER.size + slots * slot_size
+        with self._locked(self._fd):
+            # first worker in (or a changed layout) sets the table up, the rest just map it
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+            if self.HEADER.unpack_from(self._mm, 0) != (self.MAGIC, slots, slot_size):
+                self._mm[:] = bytes(size)
+                self.HEADER.pack_into(self._mm, 0, self.MAGIC, slots, slot_size)
+
+    # the critical sections are a few memcpy's, so blocking the loop on flock is cheaper than a thread hop
+    @contextmanager
+    def _locked(self, fd: int | None = None):
+        with self._thread_lock:
+            self._fcntl.flock(self._fd if fd is None else fd, self._fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._fcntl.flock(self._fd if fd is None else fd, self._fcntl.LOCK_UN)
+
+    def _offset(self, index: int) -> int:
+        return self.HEADER.size + index * self.slot_size
+
+    # (slot holding key, slot to write it to otherwise); hashlib because hash() differs per process
+    def _find(self, key: bytes, now: float):
+        start = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+        free, oldest, oldest_expiry = None, None, None
+        for i in range(self.PROBES):
+            index = (start + i) % self.slots
+            offset = self._offset(index)
+            expires_at, key_len, _ = self.SLOT.unpack_from(self._mm, offset)
+            if expires_at <= now or key_len == 0:
+                if free is None:
+                    free = index
+                continue
+            key_start = offset + self.SLOT.size
+            if self._mm[key_start:key_start + key_len] == key:
+                return index, index
+            if oldest_expiry is None or expires_at < oldest_expiry:
+                oldest, oldest_expiry = index, expires_at
+        return None, free if free is not None else oldest
+
+    def _read(self, index: int) -> str:
+        offset = self._offset(index)
+        _, key_len, value_len = self.SLOT.unpack_from(self._mm, offset)
+        start = offset + self.SLOT.size + key_len
+        return self._mm[start:start + value_len].decode()
+
+    def _write(self, index: int, key: bytes, text: str, ttl: float) -> bool:
+        value = text.encode()
+        if self.SLOT.size + len(key) + len(value) > self.slot_size:
+            return False  # too big for a slot, callers just miss the cache for it
+        offset = self._offset(index)
+        start = offset + self.SLOT.size
+        self._mm[start:start + len(key)] = key
+        self._mm[start + len(key):start + len(key) + len(value)] = value
+        self.SLOT.pack_into(self._mm, offset, time.time() + ttl, len(key), len(value))
+        return True
+
+    async def get(self, key: str):
+        with self._locked():
+            found, _ = self._find(key.encode(), time.time())
+            text = None if found is None else self._read(found)
+        return None if text is None else json.loads(text)
+
+    async def set(self, key: str, value, ttl: float):
+        text = _encode(value)
+        with self._locked():
+            _, index = self._find(key.encode(), time.time())
+            self._write(index, key.encode(), text, ttl)
+
+    async def compare_and_set(self, key: str, expected, value, ttl: float) -> bool:
+        text = _encode(value)
+        with self._locked():
+            found, index = self._find(key.encode(), time.time())
+            current = None if found is None else self._read(found)
+            if current != (None if expected is None else _encode(expected)):
+                return False
+            return self._write(index, key.encode(), text, ttl)
+
+    async def delete(self, key: str):
+        with self._locked():
+            found, _ = self._find(key.encode(), time.time())
+            if found is not None:
+                self.SLOT.pack_into(self._mm, self._offset(found), 0.0, 0, 0)
+
+
+class PostgresCacheBackend:
+    name = "postgres"
+    shared = True
+
+    async def get(self, key: str):
+        row = await repository.cache_get(key)
+        return None if row is None else json.loads(row[0])
+
+    async def set(self, key: str, value, ttl: float):
+        await repository.cache_set(key, _encode(value), ttl)
+
+    async def compare_and_set(self, key: str, expected, value, ttl: float) -> bool:
+        return await repository.cache_compare_and_set(key, None if expected is None else _encode(expected), _encode(value), ttl)
+
+    async def delete(self, key: str):
+        await repository.cache_delete(key)
+
+
+BACKENDS = {
+    "memory": MemoryCacheBackend,
+    "shm": SharedMemoryCacheBackend,
+    "postgres": PostgresCacheBackend,
+}
+
+cache = BACKENDS[CACHE_BACKEND]()
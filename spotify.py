@@ -1,39 +1,161 @@
 import os
 import time
+import uuid
+import asyncio
 import httpx
-from fastapi import APIRouter, HTTPException, status, Query, Depends
+from fastapi import APIRouter, status, Query, Depends, Request
+from pydantic import BaseModel, Field
 from jwt_utils import current_admin
+from cache_utils import TTLCache
+from shared_cache import cache as shared_cache
+from metrics import SPOTIFY_SECONDS, SPOTIFY_BATCH_SECONDS
+from timing import span
+from http_cache import cached_json
+from resilience import CircuitBreaker, UpstreamError, UpstreamUnavailable, parse_retry_after
 
 router = APIRouter(prefix="/api/spotify")
 
 SPOTIFY_CLIENT_ID = os.environ.get("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.environ.get("SPOTIFY_CLIENT_SECRET")
 
+SPOTIFY_MAX_CONNECTIONS = int(os.environ.get("SPOTIFY_MAX_CONNECTIONS", "20"))
+SPOTIFY_MAX_KEEPALIVE = int(os.environ.get("SPOTIFY_MAX_KEEPALIVE", "10"))
+SPOTIFY_KEEPALIVE_EXPIRY = float(os.environ.get("SPOTIFY_KEEPALIVE_EXPIRY", "60"))
+SPOTIFY_HTTP2 = os.environ.get("SPOTIFY_HTTP2", "0") == "1"
+# per call, well under the client's own 10s timeout so a slow spotify can't hold a request for long
+SPOTIFY_DEADLINE = float(os.environ.get("SPOTIFY_DEADLINE", "5"))
+# backoff after a 429 that didn't say how long to wait
+SPOTIFY_DEFAULT_BACKOFF = float(os.environ.get("SPOTIFY_DEFAULT_BACKOFF", "5"))
+# searches in flight at once across all batch requests, so a big batch can't take every connection
+SPOTIFY_BATCH_CONCURRENCY = int(os.environ.get("SPOTIFY_BATCH_CONCURRENCY", "8"))
+SPOTIFY_BATCH_MAX_QUERIES = int(os.environ.get("SPOTIFY_BATCH_MAX_QUERIES", "25"))
+
+SEARCH_CACHE_SIZE = int(os.environ.get("SPOTIFY_SEARCH_CACHE_SIZE", "2048"))
+SEARCH_CACHE_TTL = float(os.environ.get("SPOTIFY_SEARCH_CACHE_TTL", "300"))
+# how long past the ttl an entry can still be served while it refreshes (or while spotify is rate limiting us)
+SEARCH_STALE_TTL = float(os.environ.get("SPOTIFY_SEARCH_STALE_TTL", "3600"))
+# how long the browser may reuse a search response without asking again
+SEARCH_MAX_AGE = int(os.environ.get("SPOTIFY_SEARCH_MAX_AGE", "300"))
+
+# this worker's copy; the shared cache holds the one every worker uses
 spotify_token = {"access_token": None, "expires_at": 0.0}
+_token_lock = asyncio.Lock()
+TOKEN_KEY = "spotify:token"
+TOKEN_LEASE_KEY = "spotify:token:lease"
+# whoever holds the lease fetches the token, the other workers wait this long for it before giving up and fetching too
+TOKEN_LEASE_SECONDS = 10
 
+breaker = CircuitBreaker("spotify")
 
-async def get_access_token() -> str:
-    now = time.time()
-    if spotify_token["access_token"] and now < spotify_token["expires_at"] - 30:
+# one client for the life of the app so searches reuse warm connections
+_client: httpx.AsyncClient | None = None
+
+
+async def open_client(transport: httpx.AsyncBaseTransport | None = None):
+    global _client
+    if _client is not None:
+        return
+    http2 = SPOTIFY_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401  (httpx needs the h2 extra for http/2)
+        except ImportError:
+            http2 = False
+    _client = httpx.AsyncClient(
+        timeout=10,
+        http2=http2,
+        transport=transport,
+        limits=httpx.Limits(
+            max_connections=SPOTIFY_MAX_CONNECTIONS,
+            max_keepalive_connections=SPOTIFY_MAX_KEEPALIVE,
+            keepalive_expiry=SPOTIFY_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_client() -> httpx.AsyncClient:
+    # lifespan normally opens it, this just covers scripts/tests that skip startup
+    if _client is None:
+        await open_client()
+    return _client
+
+
+def is_configured() -> bool:
+    return bool(SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET)
+
+
+def _cached_token() -> str | None:
+    if spotify_token["access_token"] and time.time() < spotify_token["expires_at"] - 30:
         return spotify_token["access_token"]
+    return None
 
-    data = {"grant_type": "client_credentials"}
-    auth = (SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        res = await client.post(
-            "https://accounts.spotify.com/api/token",
-            data=data,
-            auth=auth,
-        )
+# takes a token another worker stored if it's still good and isn't the one that just got rejected
+def _adopt(entry: dict | None, stale: str | None) -> str | None:
+    if entry is None or entry["access_token"] == stale or time.time() >= entry["expires_at"] - 30:
+        return None
+    spotify_token.update(entry)
+    return entry["access_token"]
 
-    if res.status_code != 200:
-        raise HTTPException(status_code=500, detail="spotify auth failed")
+
+async def _fetch_token() -> dict:
+    client = await get_client()
+    now = time.time()
+    async with breaker.guard(SPOTIFY_DEADLINE):
+        with SPOTIFY_SECONDS.time("token"), span("spotify-token"):
+            res = await client.post(
+                "https://accounts.spotify.com/api/token",
+                data={"grant_type": "client_credentials"},
+                auth=(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET),
+            )
+        if res.status_code != 200:
+            raise UpstreamError("spotify", f"token request returned {res.status_code}")
 
     body = res.json()
-    spotify_token["access_token"] = body["access_token"]
-    spotify_token["expires_at"] = now + body.get("expires_in", 3600)
-    return spotify_token["access_token"]
+    entry = {"access_token": body["access_token"], "expires_at": now + body.get("expires_in", 3600)}
+    spotify_token.update(entry)
+    await shared_cache.set(TOKEN_KEY, entry, entry["expires_at"] - now)
+    return entry
+
+
+async def get_access_token(stale: str | None = None) -> str:
+    token = _cached_token()
+    if token and token != stale:
+        return token
+
+    async with _token_lock:
+        # whoever held the lock before us may have already refreshed it
+        token = _cached_token()
+        if token and token != stale:
+            return token
+
+        # or another worker did
+        token = _adopt(await shared_cache.get(TOKEN_KEY), stale)
+        if token:
+            return token
+
+        lease = uuid.uuid4().hex
+        if await shared_cache.compare_and_set(TOKEN_LEASE_KEY, None, lease, TOKEN_LEASE_SECONDS):
+            try:
+                return (await _fetch_token())["access_token"]
+            finally:
+                await shared_cache.delete(TOKEN_LEASE_KEY)
+
+        deadline = time.monotonic() + TOKEN_LEASE_SECONDS
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            token = _adopt(await shared_cache.get(TOKEN_KEY), stale)
+            if token:
+                return token
+        # the lease holder died or spotify is slow, don't make every request wait on it
+        return (await _fetch_token())["access_token"]
 
 
 def simplify_track(t: dict) -> dict:
@@ -48,43 +170,158 @@ def simplify_track(t: dict) -> dict:
     }
 
 
-async def search_tracks(q: str) -> dict:
-    token = await get_access_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    params = {"q": q, "type": "track", "limit": 8, "market": "US"}
-
-    async with httpx.AsyncClient(timeout=10) as client:
-        res = await client.get(
-            "https://api.spotify.com/v1/search",
-            params=params,
-            headers=headers,
-        )
-
-    # one retry if token expired
-    if res.status_code == 401:
-        spotify_token["access_token"] = None
-        token = await get_access_token()
-        headers["Authorization"] = f"Bearer {token}"
-        async with httpx.AsyncClient(timeout=10) as client:
+async def _get_search(params: dict, token: str) -> httpx.Response:
+    client = await get_client()
+    async with breaker.guard(SPOTIFY_DEADLINE):
+        with SPOTIFY_SECONDS.time("search"), span("spotify"):
             res = await client.get(
                 "https://api.spotify.com/v1/search",
                 params=params,
-                headers=headers,
+                headers={"Authorization": f"Bearer {token}"},
             )
+        if res.status_code >= 500:
+            raise UpstreamError("spotify", f"search returned {res.status_code}")
+    return res
+
+
+async def search_tracks(q: str) -> dict:
+    params = {"q": q, "type": "track", "limit": 8, "market": "US"}
+    try:
+        token = await get_access_token()
+        res = await _get_search(params, token)
+
+        # one retry if token expired, passing the rejected token so only one request refreshes it
+        if res.status_code == 401:
+            token = await get_access_token(stale=token)
+            res = await _get_search(params, token)
+    except UpstreamUnavailable as e:
+        if e.reason == "rate_limited":
+            return {"error": "rate_limited"}
+        raise
 
     if res.status_code == 429:
-        # surface as a soft error so UI can show a friendly message
+        # every request in this worker waits out the window instead of extending it;
+        # surface as a soft error so UI can show a friendly message (and cached_search serves stale copies)
+        breaker.defer(parse_retry_after(res.headers.get("retry-after")) or SPOTIFY_DEFAULT_BACKOFF)
         return {"error": "rate_limited"}
 
     if res.status_code != 200:
-        raise HTTPException(status_code=res.status_code, detail=res.text)
+        # spotify's error body stays in our logs, not in our responses
+        print(f"spotify search returned {res.status_code}: {res.text[:200]}")
+        raise UpstreamError("spotify", f"search returned {res.status_code}")
 
     items = res.json().get("tracks", {}).get("items", [])
     return {"tracks": [simplify_track(t) for t in items]}
 
 
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, stale_ttl=SEARCH_STALE_TTL)
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def normalize_query(q: str) -> str:
+    return " ".join(q.lower().split())
+
+
+async def _fetch_and_cache(key: str) -> dict:
+    # with a shared backend, a search any worker already did doesn't go to spotify again
+    shared_key = f"spotify:search:{key}"
+    if shared_cache.shared:
+        result = await shared_cache.get(shared_key)
+        if result is not None:
+            search_cache.set(key, result)
+            return result
+
+    result = await search_tracks(key)
+    if "error" not in result:
+        search_cache.set(key, result)
+        if shared_cache.shared:
+            await shared_cache.set(shared_key, result, SEARCH_CACHE_TTL)
+    return result
+
+
+def _search_task(key: str) -> asyncio.Task:
+    # every caller asking for the same key while it's in flight shares this one task
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_and_cache(key))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: (_inflight.pop(key, None), t.cancelled() or t.exception()))
+    return task
+
+
+async def cached_search(q: str) -> dict:
+    key = normalize_query(q)
+    found = search_cache.lookup(key)
+    if found is not None:
+        result, fresh = found
+        if not fresh:
+            _search_task(key)  # refresh in the background, the stale copy goes out now
+        return result
+    # shield so one client disconnecting doesn't cancel the fetch for everyone else waiting on it
+    return await asyncio.shield(_search_task(key))
+
+
 @router.get("/search", dependencies=[Depends(current_admin)], status_code=status.HTTP_200_OK)
 async def search_tracks_get(
+    request: Request,
     q: str = Query(..., min_length=1),
 ):
-    return await search_tracks(q)
+    result = await cached_search(q)
+    # a rate_limited answer shouldn't stick around in the browser
+    return cached_json(request, result, 0 if "error" in result else SEARCH_MAX_AGE)
+
+
+_batch_slots = asyncio.Semaphore(SPOTIFY_BATCH_CONCURRENCY)
+
+
+async def _timed_search(q: str) -> dict:
+    start = time.perf_counter()
+    try:
+        async with _batch_slots:
+            result = await cached_search(q)
+    except Exception:
+        result = {"error": "search_failed"}  # one bad query shouldn't sink the rest of the batch
+    elapsed = time.perf_counter() - start
+    SPOTIFY_BATCH_SECONDS.observe(elapsed, "query")
+    return {"query": q, **result, "ms": round(elapsed * 1000, 1)}
+
+
+# results come back in query order; repeats of a query share one fetch through cached_search
+async def search_many(queries: list[str]) -> list[dict]:
+    with SPOTIFY_BATCH_SECONDS.time("batch"):
+        return await asyncio.gather(*(_timed_search(q) for q in queries))
+
+
+def _rec_query(rec) -> str | None:
+    if not isinstance(rec, dict) or not rec.get("title"):
+        return None
+    return f"{rec['title']} {rec.get('artist') or ''}".strip()
+
+
+# adds "spotify": the first track for each {title, artist} (or None), without touching the originals
+async def enrich_recs(recs: list) -> list:
+    queries = [_rec_query(rec) for rec in recs]
+    results = iter(await search_many([q for q in queries if q]))
+    enriched = []
+    for rec, q in zip(recs, queries):
+        if q is None:
+            enriched.append(rec)
+            continue
+        tracks = next(results).get("tracks") or []
+        enriched.append({**rec, "spotify": tracks[0] if tracks else None})
+    return enriched
+
+
+class SearchBatch(BaseModel):
+    queries: list[str] = Field(min_length=1, max_length=SPOTIFY_BATCH_MAX_QUERIES)
+
+
+@router.post("/search/batch", dependencies=[Depends(current_admin)], status_code=status.HTTP_200_OK)
+async def search_tracks_batch(body: SearchBatch):
+    start = time.perf_counter()
+    results = await search_many(body.queries)
+    return {
+        "results": results,
+        "ms": round((time.perf_counter() - start) * 1000, 1),
+        "max_query_ms": max(r["ms"] for r in results),
+    }
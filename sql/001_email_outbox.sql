@@ -0,0 +1,18 @@
+-- queued emails, written in the same transaction as the row that needs them and sent by the outbox dispatcher
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    text_body TEXT NOT NULL,
+    html_body TEXT,
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    sent_at TIMESTAMPTZ,
+    failed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS email_outbox_pending_idx
+    ON email_outbox (next_attempt_at)
+    WHERE sent_at IS NULL AND failed_at IS NULL;
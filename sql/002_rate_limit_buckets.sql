@@ -0,0 +1,10 @@
+-- token buckets for the auth rate limiter when RATE_LIMIT_STORE=postgres
+-- unlogged: losing buckets on a crash just resets the limits, not worth the WAL
+CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+    key TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    allowed BOOLEAN NOT NULL DEFAULT TRUE,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS rate_limit_buckets_updated_at_idx ON rate_limit_buckets (updated_at);
@@ -0,0 +1,12 @@
+-- indexes for the maintenance sweeps in maintenance.py
+
+-- lets unverified accounts be aged out; existing rows start their clock from when this runs
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+CREATE INDEX IF NOT EXISTS users_unverified_created_at_idx ON users (created_at) WHERE NOT email_verified;
+
+CREATE INDEX IF NOT EXISTS email_verifications_expires_at_idx ON email_verifications (expires_at);
+CREATE INDEX IF NOT EXISTS email_verifications_used_at_idx ON email_verifications (used_at) WHERE used_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS email_verifications_user_id_idx ON email_verifications (user_id);
+
+CREATE INDEX IF NOT EXISTS email_outbox_done_idx ON email_outbox (created_at) WHERE sent_at IS NOT NULL OR failed_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS refresh_tokens_expires_at_idx ON refresh_tokens (expires_at);
@@ -0,0 +1,9 @@
+-- shared cache for CACHE_BACKEND=postgres (spotify token, search results) across workers and hosts
+-- unlogged: it's a cache, after a crash everything just gets fetched again
+CREATE UNLOGGED TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS cache_entries_expires_at_idx ON cache_entries (expires_at);
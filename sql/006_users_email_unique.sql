@@ -0,0 +1,4 @@
+-- optional: one account per email. signup already checks first, this closes the race between two signups.
+-- case-insensitive to match how signup normalizes emails. fails if duplicates already exist, find them with
+--   SELECT lower(email), count(*) FROM users GROUP BY 1 HAVING count(*) > 1;
+CREATE UNIQUE INDEX IF NOT EXISTS users_email_lower_key ON users (lower(email));
@@ -0,0 +1,3 @@
+-- required: signup and /api/auth/availability look emails up by lower(email).
+-- not unique, so it goes in whether or not duplicates exist; 006 adds the unique version if you want it
+CREATE INDEX IF NOT EXISTS users_email_lower_idx ON users (lower(email));
@@ -0,0 +1,152 @@
+import asyncio
+import pytest
+import admission
+import db
+from admission import AdmissionClass, AdmissionMiddleware, Rejected, classify, CLASSES
+
+
+def test_admits_up_to_the_limit_then_queues_fifo():
+    async def scenario():
+        gate = AdmissionClass("test", limit=2, queue=4, deadline=1)
+        await gate.acquire()
+        await gate.acquire()
+        order = []
+
+        async def waiter(name):
+            await gate.acquire()
+            order.append(name)
+
+        tasks = [asyncio.create_task(waiter(name)) for name in ("a", "b", "c")]
+        await asyncio.sleep(0)
+        assert gate.stats() == {"limit": 2, "max_limit": 2, "active": 2, "queued": 3}
+
+        gate.release(0.1)
+        gate.release(0.1)
+        await asyncio.sleep(0)
+        assert order == ["a", "b"]
+        gate.release(0.1)
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "c"]
+        assert gate.active == 2
+
+    asyncio.run(scenario())
+
+
+def test_rejects_when_the_queue_is_full():
+    async def scenario():
+        gate = AdmissionClass("test", limit=1, queue=1, deadline=1)
+        await gate.acquire()
+        queued = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as e:
+            await gate.acquire()
+        assert e.value.reason == "queue_full"
+        assert e.value.retry_after > 0
+        gate.release(0.1)
+        await queued
+
+    asyncio.run(scenario())
+
+
+def test_rejects_after_the_deadline_and_leaves_the_queue():
+    async def scenario():
+        gate = AdmissionClass("test", limit=1, queue=4, deadline=0.01)
+        await gate.acquire()
+        with pytest.raises(Rejected) as e:
+            await gate.acquire()
+        assert e.value.reason == "deadline"
+        assert gate.stats()["queued"] == 0
+        gate.release(0.1)
+        assert gate.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_gives_back_a_slot_it_was_handed():
+    async def scenario():
+        gate = AdmissionClass("test", limit=1, queue=4, deadline=1)
+        await gate.acquire()
+        first = asyncio.create_task(gate.acquire())
+        second = asyncio.create_task(gate.acquire())
+        await asyncio.sleep(0)
+
+        gate.release(0.1)  # hands the slot to `first`, which is cancelled before it runs
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await second  # the slot moved on instead of leaking
+        assert gate.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_db_bound_limit_shrinks_on_slow_checkouts_and_recovers(monkeypatch):
+    gate = AdmissionClass("test", limit=8, queue=4, deadline=1, db_bound=True)
+    monkeypatch.setattr(db.checkout_wait, "value", admission.ADMISSION_DB_WAIT_TARGET_MS * 2 / 1000)
+    for _ in range(3):
+        gate.active += 1
+        gate._last_adjust = 0.0
+        gate.release(0.1)
+    assert gate.stats()["limit"] == 3  # 8 * 0.75 ** 3
+
+    monkeypatch.setattr(db.checkout_wait, "value", 0.0)
+    for _ in range(10):
+        gate.active += 1
+        gate._last_adjust = 0.0
+        gate.release(0.1)
+    assert gate.stats()["limit"] == 8
+
+
+def test_limit_never_drops_below_one(monkeypatch):
+    gate = AdmissionClass("test", limit=2, queue=4, deadline=1, db_bound=True)
+    monkeypatch.setattr(db.checkout_wait, "value", 10.0)
+    for _ in range(10):
+        gate.active += 1
+        gate._last_adjust = 0.0
+        gate.release(0.1)
+    assert gate.limit == 1.0
+
+
+@pytest.mark.parametrize("path, expected", [
+    ("/api/auth/signin", "auth"),
+    ("/api/auth/signup", "auth"),
+    ("/api/admin/songrecs", "llm"),
+    ("/api/spotify/search", "spotify"),
+    ("/api/users", "db"),
+    ("/api/admin/metrics", None),
+    ("/readyz", None),
+    ("/livez", None),
+])
+def test_classify(path, expected):
+    admission_class = classify(path)
+    assert (admission_class.name if admission_class else None) == expected
+
+
+def test_middleware_answers_503_with_retry_after(monkeypatch):
+    gate = AdmissionClass("test", limit=1, queue=0, deadline=1)
+    monkeypatch.setattr(admission, "ADMISSION_ENABLED", True)
+    monkeypatch.setitem(CLASSES, "db", gate)
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def scenario():
+        await gate.acquire()  # someone else holds the only slot
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/api/users", "headers": []}
+        await AdmissionMiddleware(app)(scope, None, send)
+        assert sent[0]["status"] == 503
+        assert dict(sent[0]["headers"])[b"retry-after"] == b"1"
+
+        gate.release(0.1)
+        sent.clear()
+        await AdmissionMiddleware(app)(scope, None, send)
+        assert sent[0]["status"] == 200
+        assert gate.active == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+from open_ai_manager import JSONObjectStream
+
+
+def feed_all(chunks) -> list[dict]:
+    parser = JSONObjectStream()
+    objects = []
+    for chunk in chunks:
+        objects.extend(parser.feed(chunk))
+    return objects
+
+
+def test_objects_in_an_array():
+    assert feed_all(['[{"title": "a"}, {"title": "b"}]']) == [{"title": "a"}, {"title": "b"}]
+
+
+def test_braces_and_brackets_inside_strings():
+    text = '[{"title": "}{ ][ weird", "artist": "{x}"}]'
+    assert feed_all([text]) == [{"title": "}{ ][ weird", "artist": "{x}"}]
+
+
+def test_escaped_quotes_and_backslashes():
+    text = r'[{"title": "say \"hi\" }", "artist": "back\\"}, {"title": "next"}]'
+    assert feed_all([text]) == [{"title": 'say "hi" }', "artist": "back\\"}, {"title": "next"}]
+
+
+def test_code_fence_around_the_json():
+    text = '```json\n[\n  {"title": "a"},\n  {"title": "b"}\n]\n```'
+    assert feed_all([text]) == [{"title": "a"}, {"title": "b"}]
+
+
+def test_object_split_across_chunks():
+    text = '[{"title": "a \\" }", "tags": ["x", "y"]}, {"title": "b"}]'
+    # every split point, including inside strings and right after the backslash
+    for cut in range(1, len(text)):
+        assert feed_all([text[:cut], text[cut:]]) == [{"title": 'a " }', "tags": ["x", "y"]}, {"title": "b"}]
+
+
+def test_one_character_at_a_time():
+    text = '```json\n[{"title": "a"}, {"title": "b", "n": {"x": 1}}]\n```'
+    assert feed_all(list(text)) == [{"title": "a"}, {"title": "b", "n": {"x": 1}}]
+
+
+def test_objects_come_out_as_soon_as_they_close():
+    parser = JSONObjectStream()
+    assert parser.feed('[{"title": "a"}, {"tit') == [{"title": "a"}]
+    assert parser.feed('le": "b"}') == [{"title": "b"}]
+
+
+def test_malformed_object_is_skipped():
+    text = '[{"title": "a",}, {"title": b}, {"title": "c"}]'
+    assert feed_all([text]) == [{"title": "c"}]
+
+
+def test_truncated_stream_yields_only_complete_objects():
+    assert feed_all(['[{"title": "a"}, {"title": "b"']) == [{"title": "a"}]
@@ -0,0 +1,150 @@
+import asyncio, types
+import pytest
+import resilience
+from resilience import CircuitBreaker, UpstreamError, UpstreamUnavailable, CLOSED, OPEN, HALF_OPEN
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    # only the breaker's view of time, asyncio keeps the real clock
+    monkeypatch.setattr(resilience, "time", types.SimpleNamespace(monotonic=clock.monotonic, time=resilience.time.time))
+    return clock
+
+
+@pytest.fixture
+def breaker():
+    breaker = CircuitBreaker("test-upstream", failure_threshold=3, reset_seconds=30)
+    yield breaker
+    resilience.BREAKERS.pop("test-upstream", None)
+
+
+async def call(breaker, exc: BaseException | None = None, deadline: float | None = None, sleep: float = 0):
+    async with breaker.guard(deadline):
+        if sleep:
+            await asyncio.sleep(sleep)
+        if exc is not None:
+            raise exc
+
+
+def fail(breaker, times: int):
+    for _ in range(times):
+        with pytest.raises(UpstreamError):
+            asyncio.run(call(breaker, ConnectionError()))
+
+
+def test_opens_after_threshold_failures_in_a_row(clock, breaker):
+    fail(breaker, 2)
+    assert breaker.state == CLOSED
+    fail(breaker, 1)
+    assert breaker.state == OPEN
+    assert breaker.opened == 1
+
+    with pytest.raises(UpstreamUnavailable) as e:
+        asyncio.run(call(breaker))
+    assert e.value.reason == "circuit_open"
+    assert e.value.retry_after == pytest.approx(30)
+    assert breaker.rejected == 1
+
+
+def test_success_resets_the_failure_count(clock, breaker):
+    fail(breaker, 2)
+    asyncio.run(call(breaker))
+    fail(breaker, 2)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_trial_closes_on_success(clock, breaker):
+    fail(breaker, 3)
+    clock.now += 30
+    assert breaker.state == HALF_OPEN
+    asyncio.run(call(breaker))
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_half_open_trial_reopens_on_failure(clock, breaker):
+    fail(breaker, 3)
+    clock.now += 30
+    fail(breaker, 1)
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == pytest.approx(30)
+
+
+def test_only_one_trial_call_while_half_open(clock, breaker):
+    fail(breaker, 3)
+    clock.now += 30
+    breaker.before_call()  # the trial, still in flight
+    with pytest.raises(UpstreamUnavailable):
+        breaker.before_call()
+
+
+def test_cancelled_trial_frees_the_slot(clock, breaker):
+    fail(breaker, 3)
+    clock.now += 30
+
+    async def cancel_trial():
+        task = asyncio.create_task(call(breaker, sleep=10))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_trial())
+    assert breaker.failures == 3  # a cancel says nothing about the upstream
+    asyncio.run(call(breaker))
+    assert breaker.state == CLOSED
+
+
+def test_deadline_counts_as_a_failure(breaker):
+    with pytest.raises(UpstreamError) as e:
+        asyncio.run(call(breaker, deadline=0.01, sleep=1))
+    assert e.value.detail == "timed out"
+    assert breaker.failures == 1
+
+
+def test_non_tripping_error_counts_as_a_success(clock, breaker):
+    fail(breaker, 2)
+    with pytest.raises(UpstreamError):
+        asyncio.run(call(breaker, UpstreamError("test-upstream", "bad request", trip=False)))
+    assert breaker.failures == 0
+
+
+def test_defer_blocks_calls_until_retry_after(clock, breaker):
+    breaker.defer(12)
+    assert breaker.retry_after() == pytest.approx(12)
+    with pytest.raises(UpstreamUnavailable) as e:
+        asyncio.run(call(breaker))
+    assert e.value.reason == "rate_limited"
+    with pytest.raises(UpstreamUnavailable):
+        breaker.raise_if_blocked()
+
+    clock.now += 12
+    breaker.raise_if_blocked()
+    asyncio.run(call(breaker))
+    assert breaker.state == CLOSED
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("soon", None),
+    ("7", 7.0),
+    ("-3", 0.0),
+    ("99999", resilience.MAX_RETRY_AFTER),
+])
+def test_parse_retry_after(value, expected):
+    assert resilience.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    from email.utils import formatdate
+    assert resilience.parse_retry_after(formatdate(resilience.time.time() + 60, usegmt=True)) == pytest.approx(60, abs=2)
@@ -0,0 +1,145 @@
+import os, io, time, pstats, cProfile, asyncio
+from contextvars import ContextVar
+from contextlib import contextmanager
+
+# who gets the Server-Timing header: "admin" (the default), "all" or "off". the spans give away what a
+# request did (e.g. whether signin hashed a password), so "all" is for local benchmarking only
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "admin")
+# requests slower than this get their spans printed; 0 turns the log off
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "1000"))
+PROFILE_HEADER = b"x-profile"
+PROFILE_LINES = int(os.environ.get("PROFILE_LINES", "40"))
+
+# spans for the request being handled, None outside of one (background tasks, the outbox, startup)
+_spans: ContextVar[list | None] = ContextVar("spans", default=None)
+# [shown] for the request being handled; a list so a flip made deeper in the request is seen here
+_show_timing: ContextVar[list | None] = ContextVar("show_timing", default=None)
+
+
+# times the block into the current request's Server-Timing; a no-op outside a request.
+# names end up in the header, so stick to letters, digits and dashes
+@contextmanager
+def span(name: str):
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, time.perf_counter() - start))
+
+
+# called by the auth dependency once it knows the caller is an admin; the middleware reads it when the
+# response starts, so deciding who gets Server-Timing never costs a lookup of its own
+def show_server_timing():
+    shown = _show_timing.get()
+    if shown is not None:
+        shown[0] = True
+
+
+# same names are summed, e.g. three queries come out as one db-query entry with desc="3"
+def server_timing(spans: list, total: float) -> str:
+    totals = {}
+    for name, seconds in spans:
+        count, summed = totals.get(name, (0, 0.0))
+        totals[name] = (count + 1, summed + seconds)
+    parts = [f'{name};dur={summed * 1000:.1f};desc="{count}"' for name, (count, summed) in totals.items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def _header(scope, name: bytes) -> str | None:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+# pure ASGI like MetricsMiddleware. Server-Timing goes out if the route's auth called show_server_timing().
+# can_profile(authorization header) -> bool decides who gets X-Profile, and only runs when that header is
+# sent: cProfile sees everything on the event loop while it runs, so it's one request at a time and the
+# numbers include whatever else was running concurrently
+class TimingMiddleware:
+    def __init__(self, app, can_profile=None):
+        self.app = app
+        self.can_profile = can_profile
+        self._profiling = asyncio.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if (
+            self.can_profile is not None
+            and _header(scope, PROFILE_HEADER)
+            and not self._profiling.locked()
+            and await self.can_profile(_header(scope, b"authorization"))
+        ):
+            async with self._profiling:
+                await self._profile(scope, receive, send)
+            return
+
+        spans = []
+        token = _spans.set(spans)
+        shown = [SERVER_TIMING == "all"]
+        shown_token = _show_timing.set(shown)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if shown[0] and SERVER_TIMING != "off":
+                    header = server_timing(spans, time.perf_counter() - start).encode("latin-1")
+                    message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header)]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _spans.reset(token)
+            _show_timing.reset(shown_token)
+            elapsed = time.perf_counter() - start
+            if SLOW_REQUEST_MS > 0 and elapsed * 1000 >= SLOW_REQUEST_MS:
+                print(f"slow request: {scope['method']} {scope['path']} {status_code} {elapsed * 1000:.0f}ms [{server_timing(spans, elapsed)}]")
+
+    # runs the request as usual but answers with the profile instead of its body
+    async def _profile(self, scope, receive, send):
+        spans = []
+        token = _spans.set(spans)
+        status_code = 500
+
+        async def discard(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.disable()
+            _spans.reset(token)
+        elapsed = time.perf_counter() - start
+
+        out = io.StringIO()
+        out.write(f"{scope['method']} {scope['path']} -> {status_code} in {elapsed * 1000:.1f}ms\n")
+        out.write(f"server-timing: {server_timing(spans, elapsed)}\n\n")
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        body = out.getvalue().encode()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+                (b"x-profiled-status", str(status_code).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})